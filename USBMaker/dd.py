@@ -15,36 +15,2210 @@
 #   You should have received a copy of the GNU General Public License
 #   along with USBMaker.  If not, see <https://www.gnu.org/licenses/>.
 
-import subprocess
 import hashlib
 import os
+import errno
+import fcntl
+import mmap
+import struct
+import collections
+import concurrent.futures
+import threading
+import time
+import json
+import xml.etree.ElementTree
+import queue
+import shutil
+import subprocess
+import lzma
+import gzip
+import bz2
+import zlib
+import random
+import io
+import re
+import writeback
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Default size of each read/write request. Large requests keep USB sticks
+# busy, while 512 byte requests (dd's default) spend most of the time in
+# per-request overhead.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Default number of writes kept in flight by the parallel writer.
+QUEUE_DEPTH = 4
+
+# Block device ioctls.
+BLKFLSBUF = 0x1261
+BLKZEROOUT = 0x127f
+
+# Ranges passed to BLKZEROOUT must be aligned to the logical sector size.
+SECTOR_SIZE = 512
+
+# Default number of blocks that dd_multi() keeps in memory, and the time (in
+# seconds) it waits for a device to write a block before dropping it.
+RING_SIZE = 8
+STALL_TIMEOUT = 30
+
+# Journals of interrupted writes are kept here, so they survive a reboot.
+# Every JOURNAL_INTERVAL bytes the device is synced and the journal updated,
+# and the last JOURNAL_TAIL bytes are compared before resuming a write.
+JOURNAL_DIR = '/var/tmp/usbmaker'
+JOURNAL_INTERVAL = 64 * 1024 * 1024
+JOURNAL_TAIL = 4 * 1024 * 1024
+
+# Digests of the images (and their sizes once decompressed) are cached in
+# this file, so each version of an image is only hashed once.
+DIGEST_CACHE_PATH = os.path.join(JOURNAL_DIR, 'digests.json')
+
+# dd_check_sampled() compares SAMPLE_COVERAGE of the image by default, in
+# blocks of SAMPLE_BLOCK_SIZE bytes. The first and last SAMPLE_EDGE bytes
+# (the partition table and the backup GPT) are always compared.
+SAMPLE_COVERAGE = 0.05
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+SAMPLE_EDGE = 1024 * 1024
+
+# tune_writes() writes the first PROBE_SIZE bytes of the image with each of
+# these (block size, queue depth) pairs, PROBE_RUNS times, and the fastest one
+# is cached for the device's model in TUNING_PATH. With a warm-up write, that's
+# 7 writes of 4 MiB.
+PROBE_SIZE = 4 * 1024 * 1024
+PROBE_CANDIDATES = [(1024 * 1024, 1), (1024 * 1024, 4), (4 * 1024 * 1024, 1)]
+PROBE_RUNS = 2
+TUNING_PATH = os.path.join(JOURNAL_DIR, 'tuning.json')
+
+# Default number of bytes that dd() with verify_lag writes past a block
+# before reading it back.
+VERIFY_LAG = 32 * 1024 * 1024
+
+# Chunk indexes (see generate_index()) are stored next to the image, with
+# this extension added to its name.
+INDEX_EXTENSION = '.usbidx'
+INDEX_CHUNK_SIZE = 4 * 1024 * 1024
+INDEX_ALGORITHM = 'blake2b'
+
+# Default amount of memory that enable_staging() can use for images, and the
+# size of the huge pages used for them when possible.
+STAGING_BUDGET = 8 * 1024 * 1024 * 1024
+HUGE_PAGE_SIZE = 2 * 1024 * 1024
+
+# Hash algorithms that can be used to verify images, and their names.
+# crc32 and the xxHash ones only detect accidental corruption, which is what
+# verification is for, and are much faster than the cryptographic hashes.
+HASH_ALGORITHMS = collections.OrderedDict([('sha512', 'SHA-512'), ('sha256', 'SHA-256'), ('blake2b', 'BLAKE2b'),
+                                           ('crc32', 'CRC32'), ('xxh64', 'xxHash64'), ('xxh3', 'XXH3')])
+DEFAULT_HASH_ALGORITHM = 'sha512'
+
+# Amount of data hashed by benchmark_hashes() with each algorithm.
+BENCHMARK_SIZE = 256 * 1024 * 1024
+
+# Compressed images are recognized by their extension.
+COMPRESSION_EXTENSIONS = {'.xz': 'xz', '.gz': 'gzip', '.bz2': 'bzip2', '.zst': 'zstd'}
+
+# Size of each chunk of decompressed data, and the maximum number of chunks
+# waiting to be written.
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+DECOMPRESS_QUEUE_SIZE = 16
+
+# Block size used for new bmap files, the same as bmaptool.
+BMAP_BLOCK_SIZE = 4096
+
+# Buffers are aligned to this boundary, which covers the logical block size
+# of every usb device and the page size.
+ALIGNMENT = 4096
+
+
+def _allocate_buffer(size):
+    # Anonymous mmaps are page aligned, so they can be used for O_DIRECT I/O.
+    # The size is rounded up to a multiple of ALIGNMENT.
+    return mmap.mmap(-1, -(-size // ALIGNMENT) * ALIGNMENT)
+
+
+def _write_all(fd, view, offset):
+    # os.pwrite may write less than requested, so keep going until the whole
+    # buffer is written.
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+    return written
+
+
+def _open_device_for_writing(device):
+    # The device is written with O_DIRECT when possible, so every write is a
+    # request to the device itself, and the writes of _write_parallel() are
+    # in flight at the device instead of being copied into the page cache and
+    # written back whenever the kernel decides to. Blocks that O_DIRECT can't
+    # write (like the unaligned last block of an image) go through a second,
+    # buffered file descriptor. Both refer to the same device, so syncing
+    # either one syncs both.
+    # Returns (fd, buffered_fd), which are the same if O_DIRECT is not
+    # supported (by a filesystem, for example).
+    buffered_fd = os.open('/dev/' + device, os.O_WRONLY)
+    try:
+        return os.open('/dev/' + device, os.O_WRONLY | os.O_DIRECT), buffered_fd
+    except OSError as error:
+        if error.errno != errno.EINVAL:
+            os.close(buffered_fd)
+            raise
+    return buffered_fd, buffered_fd
+
+
+def _close_device(fd, buffered_fd):
+    os.close(fd)
+    if buffered_fd != fd:
+        os.close(buffered_fd)
+
+
+def _write_direct(fd, buffered_fd, view, offset):
+    # Writes the block with O_DIRECT if it's sector aligned, falling back to
+    # the buffered file descriptor if it isn't or if the buffer itself isn't
+    # aligned (a view of a staged image at an unaligned offset, for example).
+    if fd != buffered_fd and len(view) % SECTOR_SIZE == 0 and offset % SECTOR_SIZE == 0:
+        try:
+            return _write_all(fd, view, offset)
+        except OSError as error:
+            if error.errno != errno.EINVAL:
+                raise
+    return _write_all(buffered_fd, view, offset)
+
+
+def _zero_out(fd, offset, length):
+    # Asks the device to zero the range itself, without sending the zeros.
+    fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+
+
+def _can_zero_out(device):
+    # Devices that can't zero ranges themselves report 0 here, and the kernel
+    # would fall back to writing zeros for them, which is not any faster.
+    try:
+        with open('/sys/block/' + device + '/queue/write_zeroes_max_bytes', mode='r') as zeroes_file:
+            return int(zeroes_file.read().rstrip()) > 0
+    except (OSError, ValueError):
+        return False
+
+
+def _block_writer(fd, buffered_fd, block_size, zero_policy):
+    # Returns the function used to write each block to the device, opened
+    # with _open_device_for_writing().
+    if zero_policy == 'write':
+        return lambda view, offset: _write_direct(fd, buffered_fd, view, offset)
+
+    zeros = bytes(block_size)
+    zero_out = zero_policy == 'zeroout'
+
+    def write_block(view, offset):
+        nonlocal zero_out
+        # Blocks that are all zeros are skipped (the device was already
+        # zeroed) or zeroed by the device. BLKZEROOUT needs sector aligned
+        # ranges, so the unaligned last block of an image is always written.
+        if len(view) % SECTOR_SIZE == 0 and offset % SECTOR_SIZE == 0 and zeros.startswith(view):
+            if zero_policy == 'skip':
+                return len(view)
+            if zero_out:
+                try:
+                    _zero_out(fd, offset, len(view))
+                    return len(view)
+                except OSError:
+                    # Not supported by this device, don't try again.
+                    zero_out = False
+        return _write_direct(fd, buffered_fd, view, offset)
+
+    return write_block
+
+
+def _split_extents(extents, block_size):
+    # Splits the (start, end) byte ranges of the image that have to be
+    # written into (offset, length) blocks. An end of None means "until the
+    # end of the image".
+    for start, end in extents:
+        offset = start
+        while end is None or offset < end:
+            if end is None:
+                yield offset, block_size
+            else:
+                yield offset, min(block_size, end - offset)
+            offset += block_size
+
+
+def _read_block(source, view, offset, position):
+    # Returns the block of the image at offset, read into view (which has the
+    # length of the block), or taken directly from a staged image without
+    # copying it. position is the current position of source.
+    if isinstance(source, _StagedImage):
+        return source.get_view(offset, len(view))
+    if offset != position:
+        source.seek(offset)
+    return view[:source.readinto(view)]
+
+
+def _write_sequential(source, write_block, extents, block_size, on_written, read_hook):
+    # on_written is called as on_written(bytes_written, end) after every
+    # block, where end is the offset of the image up to which every block of
+    # extents is written.
+    # A single buffer is allocated and reused for every block.
+    buffer = _allocate_buffer(block_size)
+    view = memoryview(buffer)[:block_size]
+    position = 0
+    written = 0
+
+    for offset, length in _split_extents(extents, block_size):
+        block = _read_block(source, view[:length], offset, position)
+        count = len(block)
+        if count == 0:
+            break
+        position = offset + count
+
+        if read_hook is not None:
+            read_hook(block, offset)
+        try:
+            write_block(block, offset)
+        except OSError as error:
+            raise WriteError(offset, error)
+        written += count
+        if on_written is not None:
+            on_written(written, offset + count)
+
+    return written
+
+
+def _write_parallel(source, write_block, extents, block_size, queue_depth, on_written, read_hook):
+    # Up to queue_depth blocks are written at the same time with os.pwrite,
+    # each one from its own buffer and at its own offset. The source is
+    # still read sequentially by this thread.
+    buffers = [_allocate_buffer(block_size) for _ in range(queue_depth)]
+    views = [memoryview(buffer)[:block_size] for buffer in buffers]
+    free = list(range(queue_depth))
+
+    # Writes in flight, oldest first, as (offset, count, buffer index, future).
+    # Writes are retired in order, so "written" always counts the blocks
+    # of the image, from its start, that are known to be written, even if
+    # later writes finish first.
+    pending = collections.deque()
+    position = 0
+    written = 0
+
+    def retire_oldest():
+        nonlocal written
+        offset, count, index, future = pending.popleft()
+        try:
+            future.result()
+        except OSError as error:
+            raise WriteError(offset, error)
+        free.append(index)
+        written += count
+        if on_written is not None:
+            on_written(written, offset + count)
+
+    # Leaving the with block waits for every write that was submitted, even
+    # if one of them failed, so the file descriptor is never closed under a
+    # running write.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=queue_depth) as executor:
+        for offset, length in _split_extents(extents, block_size):
+            if not free:
+                retire_oldest()
+
+            index = free.pop()
+            block = _read_block(source, views[index][:length], offset, position)
+            count = len(block)
+            if count == 0:
+                break
+            position = offset + count
+
+            # The buffer is not touched again until its write is retired, so
+            # it can be hashed here, in the order of the image.
+            if read_hook is not None:
+                read_hook(block, offset)
+
+            future = executor.submit(write_block, block, offset)
+            pending.append((offset, count, index, future))
+
+        while pending:
+            retire_oldest()
+
+    return written
+
+
+def get_compression(iso):
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(iso)[1].lower())
+
+
+def _open_image(iso):
+    # Images are read from memory if they're staged (see enable_staging()).
+    if _staging_cache is not None:
+        stage = _staging_cache.get(iso)
+        if stage is not None:
+            return _StagedImage(stage)
+    return _open_image_file(iso)
+
+
+def _open_image_file(iso):
+    # Compressed images are decompressed on the fly, in a separate thread.
+    if get_compression(iso) is None:
+        return open(iso, 'rb', buffering=0)
+    return _DecompressingReader(iso, get_compression(iso))
+
+
+def get_image_size(iso):
+    # Size of the data that dd() writes. Compressed images have to be
+    # decompressed to find it, so pass the value returned by dd() to the
+    # functions that need it when possible.
+    if get_compression(iso) is None:
+        return os.path.getsize(iso)
+
+    entry = _get_cache_entry(iso)
+    if entry.get('image_size') is not None:
+        return entry['image_size']
+
+    size = 0
+    with _open_image_file(iso) as image:
+        for block in _read_file(image):
+            size += len(block)
+    _update_cache_entry(iso, image_size=size)
+    return size
+
+
+def _plan_write(iso, hash_object, bmap):
+    # Returns the extents of the image that have to be written, the number of
+    # bytes they contain and the read hook used for them.
+    if bmap is not None:
+        if not isinstance(bmap, Bmap):
+            bmap = read_bmap(bmap)
+        check = _bmap_checker(bmap)
+        if hash_object is not None:
+            # Only the mapped ranges are hashed, as dd_check() does with a bmap.
+            def read_hook(view, offset):
+                check(view, offset)
+                hash_object.update(view)
+            return bmap.get_extents(), bmap.get_mapped_size(), read_hook
+        return bmap.get_extents(), bmap.get_mapped_size(), check
+
+    if hash_object is not None:
+        return [(0, None)], os.path.getsize(iso), lambda view, offset: hash_object.update(view)
+    return [(0, None)], os.path.getsize(iso), None
+
+
+def _prepare_zero_policy(fd, device, iso, zero_policy):
+    # Returns the zero policy that can be used for this image and device,
+    # zeroing the image area of the device if the policy is 'skip'.
+    if zero_policy == 'skip':
+        if get_compression(iso) is not None:
+            # The size of the decompressed image isn't known beforehand.
+            return 'zeroout'
+        if not _can_zero_out(device):
+            return 'write'
+        try:
+            _zero_out(fd, 0, os.path.getsize(iso) // SECTOR_SIZE * SECTOR_SIZE)
+        except OSError:
+            return 'write'
+    return zero_policy
+
+
+def _clip_extents(extents, start, end=None):
+    # Returns the parts of extents that are between start and end (None
+    # meaning the end of the image).
+    clipped = []
+    for extent_start, extent_end in extents:
+        if end is not None and (extent_end is None or extent_end > end):
+            extent_end = end
+        extent_start = max(extent_start, start)
+        if extent_end is None or extent_start < extent_end:
+            clipped.append((extent_start, extent_end))
+    return clipped
+
+
+def _write_json_atomically(path, data):
+    # Writes data to a temporary file, syncs it and moves it over path, so
+    # path always has either the old or the new contents, even after a
+    # crash or a power failure.
+    with open(path + '.tmp', mode='w', encoding='utf_8') as json_file:
+        json.dump(data, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def _get_journal_path(journal_id):
+    return os.path.join(JOURNAL_DIR, journal_id + '.json')
+
+
+def _get_source_identity(iso, bmap):
+    # Identifies the image (and the bmap used with it), so a journal is only
+    # used to resume the same write.
+    stat = os.stat(iso)
+    identity = {'path': os.path.abspath(iso), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'inode': stat.st_ino, 'device': stat.st_dev, 'bmap': None}
+    if bmap is not None:
+        identity['bmap'] = [list(extent) for extent in bmap.get_extents()]
+    return identity
+
+
+def _read_journal(journal_id, identity):
+    # Returns the offset up to which the image was written by a previous
+    # attempt, or 0.
+    try:
+        with open(_get_journal_path(journal_id), mode='r', encoding='utf_8') as journal_file:
+            journal = json.load(journal_file)
+    except (OSError, ValueError):
+        return 0
+
+    if journal.get('source') != identity:
+        return 0
+    return journal.get('committed', 0)
+
+
+def _write_journal(journal_id, identity, committed):
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    _write_json_atomically(_get_journal_path(journal_id), {'source': identity, 'committed': committed})
+
+
+def _remove_journal(journal_id):
+    try:
+        os.remove(_get_journal_path(journal_id))
+    except FileNotFoundError:
+        pass
+
+
+def _confirm_written(iso, device, extents, block_size):
+    # Checks that the device has the same data as the image in extents.
+    fd, direct = _open_device_for_reading(device)
+    buffer = _allocate_buffer(block_size)
+    view = memoryview(buffer)
+    expected = bytearray(block_size)
+    try:
+        with _open_image(iso) as image:
+            for offset, length in _split_extents(extents, block_size):
+                image.seek(offset)
+                if image.readinto(memoryview(expected)[:length]) != length or \
+                        _pread_device(fd, direct, view, offset, length) != length or \
+                        not expected.startswith(view[:length]):
+                    return False
+    finally:
+        os.close(fd)
+    return True
+
+
+_digest_cache_lock = threading.Lock()
+
+
+def _read_digest_cache():
+    try:
+        with open(DIGEST_CACHE_PATH, mode='r', encoding='utf_8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _get_cache_key(stat):
+    return str(stat.st_dev) + ':' + str(stat.st_ino)
+
+
+def _get_cache_entry(iso):
+    # Returns the cached information about the image, or an empty dict if
+    # there's none or the image changed since it was cached.
+    stat = os.stat(iso)
+    with _digest_cache_lock:
+        entry = _read_digest_cache().get(_get_cache_key(stat), {})
+    if entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns:
+        return {}
+    return entry
+
+
+def _update_cache_entry(iso, image_size=None, digests=None):
+    # Entries for images that were changed or removed are dropped on the way.
+    stat = os.stat(iso)
+    key = _get_cache_key(stat)
+    with _digest_cache_lock:
+        cache = _read_digest_cache()
+        for other_key, entry in list(cache.items()):
+            try:
+                other_stat = os.stat(entry['path'])
+            except (OSError, KeyError, TypeError):
+                del cache[other_key]
+                continue
+            if _get_cache_key(other_stat) != other_key or other_stat.st_size != entry.get('size') or \
+                    other_stat.st_mtime_ns != entry.get('mtime_ns'):
+                del cache[other_key]
+
+        entry = cache.setdefault(key, {'path': os.path.abspath(iso), 'size': stat.st_size,
+                                       'mtime_ns': stat.st_mtime_ns, 'image_size': None, 'digests': {}})
+        if image_size is not None:
+            entry['image_size'] = image_size
+        if digests is not None:
+            entry['digests'].update(digests)
+
+        try:
+            os.makedirs(JOURNAL_DIR, exist_ok=True)
+            _write_json_atomically(DIGEST_CACHE_PATH, cache)
+        except OSError:
+            # The cache is only an optimization.
+            pass
+
+
+def _get_digest_name(algorithm, bmap):
+    # Digests computed with a bmap only cover its mapped ranges, so they are
+    # stored separately for each bmap.
+    if bmap is None:
+        return algorithm
+    extents = json.dumps([list(extent) for extent in bmap.get_extents()])
+    return algorithm + ':' + hashlib.sha256(extents.encode()).hexdigest()
+
+
+def get_cached_digest(iso, algorithm=DEFAULT_HASH_ALGORITHM, bmap=None):
+    # Returns the digest of the image (of its mapped ranges with a bmap)
+    # computed by an earlier dd_check(), or None.
+    if bmap is not None and not isinstance(bmap, Bmap):
+        bmap = read_bmap(bmap)
+    digest = _get_cache_entry(iso).get('digests', {}).get(_get_digest_name(algorithm, bmap))
+    if digest is None:
+        return None
+    return bytes.fromhex(digest)
+
+
+def _dd(iso, device, block_size, progress, queue_depth, hash_object, zero_policy, bmap, wrap_writer=None,
+        journal_id=None, sync_interval=writeback.SYNC_INTERVAL, verify_lag=None):
+    # Blocks are aligned, so the device can be read back with O_DIRECT.
+    block_size = -(-block_size // ALIGNMENT) * ALIGNMENT
+    if bmap is not None and not isinstance(bmap, Bmap):
+        bmap = read_bmap(bmap)
+    extents, total, read_hook = _plan_write(iso, hash_object, bmap)
+
+    # Resume a write that was interrupted, if its last JOURNAL_TAIL bytes
+    # are still on the device.
+    resume = 0
+    if journal_id is not None:
+        identity = _get_source_identity(iso, bmap)
+        resume = _read_journal(journal_id, identity)
+        if resume > 0:
+            tail = _clip_extents(extents, max(resume - JOURNAL_TAIL, 0), resume)
+            if not _confirm_written(iso, device, tail, block_size):
+                resume = 0
+    committed = resume
+
+    with _open_image(iso) as source:
+        fd, buffered_fd = _open_device_for_writing(device)
+        try:
+            # The bytes before resume count as written.
+            skipped = 0
+            if resume > 0:
+                skipped = sum(end - start for start, end in _clip_extents(extents, 0, resume))
+                if read_hook is not None:
+                    # The image is hashed up to resume before writing the rest.
+                    for offset, length in _split_extents(_clip_extents(extents, 0, resume), block_size):
+                        block = bytearray(length)
+                        source.seek(offset)
+                        source.readinto(block)
+                        read_hook(memoryview(block), offset)
+                extents = _clip_extents(extents, resume)
+                # Zeroing the image area again would erase what was written.
+                if zero_policy == 'skip':
+                    zero_policy = 'zeroout'
+            else:
+                zero_policy = _prepare_zero_policy(fd, device, iso, zero_policy)
+
+            # The dirty data is kept under about two sync_interval windows,
+            # and the progress only counts the bytes that reached the device.
+            device_writeback = writeback.Writeback(fd, sync_interval)
+            device_writeback.synced = device_writeback.started = resume
+            # (end, written) when each window was started.
+            windows = collections.deque()
+            synced = 0
+
+            writer_hook = read_hook
+            verifier = None
+            if verify_lag is not None:
+                verifier = _ReadbackVerifier(device, fd, block_size, verify_lag)
+
+                def verifying_hook(view, offset):
+                    if read_hook is not None:
+                        read_hook(view, offset)
+                    verifier.add(view, offset)
+                writer_hook = verifying_hook
+
+            def on_written(written, end):
+                nonlocal committed, synced
+                if verifier is not None:
+                    verifier.verify(end)
+                device_writeback.written(end)
+                if device_writeback.started == end:
+                    windows.append((end, written))
+                if windows and windows[0][0] <= device_writeback.synced:
+                    while windows and windows[0][0] <= device_writeback.synced:
+                        synced = windows.popleft()[1]
+                    if get_compression(iso) is None:
+                        # The image was read up to here, and won't be read again.
+                        writeback.drop_cache(source.fileno(), 0, device_writeback.synced)
+                if journal_id is not None and end - committed >= JOURNAL_INTERVAL:
+                    # Everything up to end has to be on the device before it
+                    # is recorded in the journal.
+                    os.fdatasync(fd)
+                    _write_journal(journal_id, identity, end)
+                    committed = end
+                if progress is not None:
+                    if get_compression(iso) is not None:
+                        progress(source.consumed, source.size)
+                    else:
+                        progress(skipped + synced, total)
+
+            write_block = _block_writer(fd, buffered_fd, block_size, zero_policy)
+            if wrap_writer is not None:
+                write_block = wrap_writer(write_block)
+            if queue_depth > 1:
+                written = _write_parallel(source, write_block, extents, block_size, queue_depth, on_written,
+                                          writer_hook)
+            else:
+                written = _write_sequential(source, write_block, extents, block_size, on_written, writer_hook)
+            written += skipped
+
+            if bmap is not None and written != total:
+                raise ChecksumError(iso + ' is smaller than the size given by its bmap.')
+
+            # Make sure everything is on the device before returning.
+            device_writeback.finish()
+            os.fsync(fd)
+            if verifier is not None:
+                verifier.verify()
+            if progress is not None and get_compression(iso) is None:
+                progress(written, total)
+        finally:
+            if verifier is not None:
+                verifier.close()
+            _close_device(fd, buffered_fd)
+
+    if journal_id is not None:
+        _remove_journal(journal_id)
+
+    return written
+
+
+def dd(iso, device, block_size=BLOCK_SIZE, progress=None, queue_depth=1, hash_object=None, zero_policy='write',
+       bmap=None, journal_id=None, sync_interval=writeback.SYNC_INTERVAL, verify_lag=None):
+    # progress is called as progress(bytes_written, bytes_total) after every
+    # block, where bytes_written only counts the bytes that reached the device.
+    # The writeback of the written data is started every sync_interval bytes,
+    # and the data of the previous interval is waited for and dropped from the
+    # page cache, along with the image data that was already written.
+    # If queue_depth is greater than 1, that many writes are kept in flight at
+    # once. The device is written with O_DIRECT, so they're all in flight at
+    # the device itself.
+    # If hash_object (for example new_hash('sha512')) is given, it is updated
+    # with every block as it is written (only the mapped ones with a bmap), so
+    # its digest can be passed to dd_check() instead of reading the image a
+    # second time.
+    # zero_policy decides what happens to blocks that only contain zeros:
+    # - 'write': they are written like any other block.
+    # - 'zeroout': the device is asked to zero them (BLKZEROOUT).
+    # - 'skip': the whole image area is zeroed by the device once, before
+    #   writing, and then they are skipped. This needs a device that can zero
+    #   ranges itself, otherwise 'write' is used. BLKDISCARD is not used, as
+    #   discarded blocks are not guaranteed to read back as zeros.
+    # If bmap (the path of a bmap file, or a Bmap) is given, only the ranges
+    # mapped by it are written, and they are checked against its checksums.
+    # Compressed images (.xz, .gz, .bz2 and .zst) are decompressed while they
+    # are written. Their progress is given in compressed bytes.
+    # If journal_id (for example the name of the device in /dev/disk/by-id/)
+    # is given, the progress of the write is recorded every JOURNAL_INTERVAL
+    # bytes, and a write of the same image that was interrupted is resumed
+    # from there.
+    # If verify_lag (for example VERIFY_LAG) is given, each block is read back
+    # from the device (bypassing the cache) once verify_lag more bytes were
+    # written after it, and compared with a copy of the image block kept in
+    # memory until then. VerifyError is raised at the first difference, so
+    # there's no need for dd_check() afterwards.
+    # Returns the number of bytes of the image that were written.
+    return _dd(iso, device, block_size, progress, queue_depth, hash_object, zero_policy, bmap,
+               journal_id=journal_id, sync_interval=sync_interval, verify_lag=verify_lag)
+
+
+def dd_delta(iso, device, block_size=BLOCK_SIZE, progress=None, queue_depth=1, hash_object=None, bmap=None):
+    # Like dd(), but each block is first read from the device (bypassing the
+    # cache) and only written if it differs from the image. Reading is much
+    # faster than writing on usb sticks, so a device that already has (most
+    # of) the image is updated in about the time it takes to read it.
+    # Returns the number of bytes that were actually written.
+    fd, direct = _open_device_for_reading(device)
+    # Every thread of the parallel writer needs its own read buffer.
+    buffers = threading.local()
+    lock = threading.Lock()
+    rewritten = 0
+
+    def wrap_writer(write_block):
+        def write_changed_block(view, offset):
+            nonlocal rewritten
+            if not hasattr(buffers, 'buffer'):
+                buffers.buffer = _allocate_buffer(block_size)
+                buffers.view = memoryview(buffers.buffer)
+
+            count = _pread_device(fd, direct, buffers.view, offset, len(view))
+            # Slicing the mmap copies the block into a bytes object, whose
+            # startswith() then compares it with view without another copy.
+            if count == len(view) and buffers.buffer[:count].startswith(view):
+                return len(view)
+
+            with lock:
+                rewritten += len(view)
+            return write_block(view, offset)
+
+        return write_changed_block
+
+    try:
+        # Zero blocks are zeroed by the device when they differ; 'skip' would
+        # zero the whole device first, which defeats the purpose.
+        _dd(iso, device, block_size, progress, queue_depth, hash_object, 'zeroout', bmap, wrap_writer)
+    finally:
+        os.close(fd)
+
+    return rewritten
+
+
+def dd_multi(iso, devices, block_size=BLOCK_SIZE, progress=None, hash_object=None, zero_policy='write', bmap=None,
+             ring_size=RING_SIZE, stall_timeout=STALL_TIMEOUT, sync_interval=writeback.SYNC_INTERVAL):
+    # Writes the same image to several devices at once, reading it only once.
+    # Each block is read into a ring of ring_size shared buffers, and every
+    # device has its own thread writing the blocks from the ring in order.
+    # A device can fall behind the reader by up to ring_size blocks. If the
+    # reader has to wait more than stall_timeout seconds for a device to
+    # finish writing a block, or if a write fails, that device is dropped and
+    # the others continue. Once everything is read, a device whose remaining
+    # writes or final flush make no progress for stall_timeout seconds is
+    # dropped too, and its thread is left behind (it closes the device if it
+    # ever returns).
+    # progress is called as progress(bytes_written, bytes_total), with the
+    # bytes written to the slowest device still being written.
+    # The other arguments are the same as for dd(). Returns a dictionary with
+    # a DeviceResult for each device.
+    extents, total, read_hook = _plan_write(iso, hash_object, bmap)
+    results = {device: DeviceResult(device) for device in devices}
+
+    buffers = [_allocate_buffer(block_size) for _ in range(ring_size)]
+    views = [memoryview(buffer)[:block_size] for buffer in buffers]
+    # (offset, block) of the block in each buffer of the ring, where block is
+    # a view of the buffer, or of the staged image.
+    blocks = [None] * ring_size
+
+    # Everything below is protected by condition. Block number n is stored
+    # in buffer n % ring_size, "produced" is the number of blocks read so far
+    # and positions has the number of the next block to write to each device.
+    condition = threading.Condition()
+    produced = 0
+    finished = False
+    positions = {}
+    active = set()
+    # Devices whose threads were left behind, stuck in a write or flush.
+    abandoned = set()
+
+    def write_device(device, fd, write_block):
+        result = results[device]
+        offset = 0
+        device_writeback = writeback.Writeback(fd, sync_interval)
+        try:
+            while True:
+                with condition:
+                    while positions[device] == produced and not finished and device in active:
+                        condition.wait()
+                    if device not in active or positions[device] == produced:
+                        break
+                    index = positions[device] % ring_size
+                    offset, block = blocks[index]
+                    count = len(block)
+
+                write_block(block, offset)
+                device_writeback.written(offset + count)
+
+                with condition:
+                    positions[device] += 1
+                    result.written += count
+                    condition.notify_all()
+
+            if device in active:
+                device_writeback.finish()
+                os.fsync(fd)
+        except OSError as error:
+            if device not in abandoned:
+                result.error = WriteError(offset, error)
+        finally:
+            with condition:
+                active.discard(device)
+                if device in abandoned:
+                    _close_device(*fds[device])
+                condition.notify_all()
+
+    def drop_stalled_devices(index):
+        # Waits until no device is still writing the block in buffer index,
+        # dropping the devices that take too long.
+        deadline = time.monotonic() + stall_timeout
+        while True:
+            stalled = [device for device in active if positions[device] <= produced - ring_size]
+            if not stalled:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            condition.wait(remaining)
+
+        for device in stalled:
+            # The thread may still be stuck in its write, from a buffer that
+            # is about to be reused, so the device has to be written again.
+            active.discard(device)
+            abandoned.add(device)
+            results[device].error = WriteError(blocks[index][0], TimeoutError(
+                'No progress in ' + str(stall_timeout) + ' seconds'))
+        condition.notify_all()
+
+    def drain(end):
+        # Waits until the devices have written the rest of the ring and
+        # flushed it, abandoning the ones that make no progress for
+        # stall_timeout seconds.
+        seen = dict(positions)
+        deadlines = {device: time.monotonic() + stall_timeout for device in active}
+        while active:
+            now = time.monotonic()
+            for device in list(active):
+                if positions[device] != seen[device]:
+                    seen[device] = positions[device]
+                    deadlines[device] = now + stall_timeout
+                elif now >= deadlines[device]:
+                    active.discard(device)
+                    abandoned.add(device)
+                    if positions[device] < produced:
+                        offset = blocks[positions[device] % ring_size][0]
+                    else:
+                        # Stuck flushing the device.
+                        offset = end
+                    results[device].error = WriteError(offset, TimeoutError(
+                        'No progress in ' + str(stall_timeout) + ' seconds'))
+            if active:
+                condition.wait(max(0, min(deadlines[device] for device in active) - now))
+
+    fds = {}
+    threads = []
+    position = 0
+    try:
+        with _open_image(iso) as source:
+            for device in devices:
+                try:
+                    fd, buffered_fd = _open_device_for_writing(device)
+                    fds[device] = (fd, buffered_fd)
+                    write_block = _block_writer(fd, buffered_fd, block_size,
+                                                _prepare_zero_policy(fd, device, iso, zero_policy))
+                except OSError as error:
+                    results[device].error = WriteError(0, error)
+                    continue
+                positions[device] = 0
+                active.add(device)
+                threads.append(threading.Thread(target=write_device, args=(device, fd, write_block), name=device,
+                                                daemon=True))
+            for thread in threads:
+                thread.start()
+
+            for offset, length in _split_extents(extents, block_size):
+                index = produced % ring_size
+                with condition:
+                    drop_stalled_devices(index)
+                    if not active:
+                        break
+
+                block = _read_block(source, views[index][:length], offset, position)
+                count = len(block)
+                if count == 0:
+                    break
+                position = offset + count
+                if read_hook is not None:
+                    read_hook(block, offset)
+
+                with condition:
+                    blocks[index] = (offset, block)
+                    produced += 1
+                    condition.notify_all()
+                    if progress is not None and active:
+                        if get_compression(iso) is not None:
+                            progress(source.consumed, source.size)
+                        else:
+                            progress(min(results[device].written for device in active), total)
+    finally:
+        with condition:
+            finished = True
+            condition.notify_all()
+            drain(position)
+        for thread in threads:
+            if thread.name not in abandoned:
+                thread.join()
+        with condition:
+            for device, (fd, buffered_fd) in fds.items():
+                if device not in abandoned:
+                    _close_device(fd, buffered_fd)
+
+    for result in results.values():
+        if result.error is None and bmap is not None and result.written != total:
+            result.error = ChecksumError(iso + ' is smaller than the size given by its bmap.')
+
+    if progress is not None:
+        if get_compression(iso) is not None:
+            total = os.path.getsize(iso)
+        progress(total, total)
+
+    return results
+
+
+_staging_cache = None
+
+
+def enable_staging(budget=STAGING_BUDGET, hugepages=True):
+    # Makes every function of this module read images from memory: the first
+    # time an image is read, it's loaded (decompressed) into a memfd, backed
+    # by huge pages if hugepages is True and the system has them. Up to budget
+    # bytes are used, and the least recently used images are dropped to make
+    # room for new ones. Images bigger than budget are read from disk.
+    # This is useful when the same images are written to many devices.
+    global _staging_cache
+    if hasattr(os, 'memfd_create'):
+        _staging_cache = _StagingCache(budget, hugepages)
+
+
+def disable_staging():
+    global _staging_cache
+    _staging_cache = None
+
+
+def get_staged_path(iso):
+    # Returns a path that the staged copy of the image can be opened (or
+    # loop mounted) from, or None if staging is disabled or the image can't
+    # be staged. The path is valid while the image stays in the cache.
+    if _staging_cache is None:
+        return None
+    stage = _staging_cache.get(iso)
+    if stage is None:
+        return None
+    return '/proc/' + str(os.getpid()) + '/fd/' + str(stage.fd)
+
+
+def get_device_model(device_id):
+    # Returns the device's vendor and model, from its /dev/disk/by-id/ name
+    # (as returned by usb_info.get_id_list()), which looks like
+    # usb-Vendor_Model_Serial-0:0.
+    match = re.match(r'usb-(.+)_[^_]*-\d+:\d+$', device_id)
+    if match is None:
+        return device_id
+    return match.group(1)
+
+
+def _read_tuning():
+    try:
+        with open(TUNING_PATH, mode='r', encoding='utf_8') as tuning_file:
+            return json.load(tuning_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_tuning(model, block_size, queue_depth):
+    tuning = _read_tuning()
+    tuning[model] = {'block_size': block_size, 'queue_depth': queue_depth}
+    try:
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        _write_json_atomically(TUNING_PATH, tuning)
+    except OSError:
+        pass
+
+
+def _probe_write(fd, buffered_fd, data, block_size, queue_depth):
+    # Returns the time it takes to write data to the start of the device,
+    # including flushing it.
+    write_block = _block_writer(fd, buffered_fd, block_size, 'write')
+    source = io.BytesIO(data)
+    extents = [(0, len(data))]
+    start = time.perf_counter()
+    if queue_depth > 1:
+        _write_parallel(source, write_block, extents, block_size, queue_depth, lambda written, end: None, None)
+    else:
+        _write_sequential(source, write_block, extents, block_size, lambda written, end: None, None)
+    os.fdatasync(fd)
+    return time.perf_counter() - start
+
+
+def tune_writes(iso, device, device_id=None, progress=None, journal_id=None, bmap=None):
+    # Returns the (block_size, queue_depth) pair that writes fastest to the
+    # device, to be passed to dd().
+    # Each candidate is measured by writing the first PROBE_SIZE bytes of the
+    # image to the device, where dd() will write the same data anyway. The
+    # writes use O_DIRECT like dd(), so they measure the device and not the
+    # page cache. A first write is discarded (the device may still be waking
+    # up or flushing older data), and then the candidates are measured in
+    # PROBE_RUNS rounds, keeping the best time of each one.
+    # progress is called as progress(bytes_written, bytes_total) after each
+    # write.
+    # The result is cached for the device's model (see get_device_model()) if
+    # device_id is given, so other devices of the same model aren't probed.
+    # If dd() will resume an interrupted write (journal_id and bmap are the
+    # ones given to it), the device isn't probed, and the defaults are used
+    # unless the model's result is cached.
+    model = None
+    if device_id is not None:
+        model = get_device_model(device_id)
+        tuning = _read_tuning().get(model)
+        if tuning is not None:
+            return tuning['block_size'], tuning['queue_depth']
+    if journal_id is not None:
+        if bmap is not None and not isinstance(bmap, Bmap):
+            bmap = read_bmap(bmap)
+        if _read_journal(journal_id, _get_source_identity(iso, bmap)) > 0:
+            return BLOCK_SIZE, QUEUE_DEPTH
 
+    with _open_image(iso) as image:
+        data = bytearray(PROBE_SIZE)
+        count = image.readinto(data)
+    if count < PROBE_SIZE:
+        # The image is too small for the measurement to mean anything.
+        return BLOCK_SIZE, QUEUE_DEPTH
 
-def dd(iso, device):
-    subprocess.run(['dd', 'if=' + iso, 'of=/dev/' + device])
-
-
-def dd_check(iso, device):
-    subprocess.run(['dd', 'if=/dev/' + device, 'of=/tmp/usbmaker_image_' + device + '.iso',
-                    'count=' + str(os.path.getsize(iso)/512)])
-    dd_hash = hashlib.sha512()
-    dd_iso = open('/tmp/usbmaker_image_' + device + '.iso', 'rb')
-    dd_iso_buffer = dd_iso.read(2**23)
-    while len(dd_iso_buffer) > 0:
-        dd_hash.update(dd_iso_buffer)
-        dd_iso_buffer = dd_iso.read(2**23)
-    dd_iso_hash = dd_hash.hexdigest()
-    os.remove('/tmp/usbmaker_image_' + device + '.iso')
-
-    iso_hash = hashlib.sha512()
-    orig_iso = open(iso, 'rb')
-    orig_iso_buffer = orig_iso.read(2**23)
-    while len(orig_iso_buffer) > 0:
-        iso_hash.update(orig_iso_buffer)
-        orig_iso_buffer = orig_iso.read(2**23)
-    orig_iso_hash = iso_hash.hexdigest()
-
-    if dd_iso_hash == orig_iso_hash:
-        return True
+    fd, buffered_fd = _open_device_for_writing(device)
+    times = {candidate: [] for candidate in PROBE_CANDIDATES}
+    total = (1 + PROBE_RUNS * len(PROBE_CANDIDATES)) * PROBE_SIZE
+    try:
+        _probe_write(fd, buffered_fd, data, *PROBE_CANDIDATES[0])
+        written = PROBE_SIZE
+        if progress is not None:
+            progress(written, total)
+        for _ in range(PROBE_RUNS):
+            for candidate in PROBE_CANDIDATES:
+                times[candidate].append(_probe_write(fd, buffered_fd, data, *candidate))
+                written += PROBE_SIZE
+                if progress is not None:
+                    progress(written, total)
+    finally:
+        _close_device(fd, buffered_fd)
+    block_size, queue_depth = min(PROBE_CANDIDATES, key=lambda candidate: min(times[candidate]))
+
+    if model is not None:
+        _write_tuning(model, block_size, queue_depth)
+    return block_size, queue_depth
+
+
+def _bmap_checker(bmap):
+    # Returns a read hook for the writers that hashes the image blocks of each
+    # mapped range and compares the result with the checksum from the bmap.
+    # The writers never split a block across two ranges.
+    ranges = iter(bmap.ranges)
+    hash_object = None
+    end = 0
+    expected = None
+
+    def check(view, offset):
+        nonlocal hash_object, end, expected
+        if offset >= end:
+            first, last, expected = next(ranges)
+            end = min((last + 1) * bmap.block_size, bmap.image_size)
+            if expected is not None:
+                hash_object = hashlib.new(bmap.checksum_type)
+
+        if expected is not None:
+            hash_object.update(view)
+            if offset + len(view) >= end and hash_object.hexdigest() != expected:
+                raise ChecksumError('Checksum mismatch in the range ending at byte ' + str(end) +
+                                    ' of the image, which does not match its bmap.')
+
+    return check
+
+
+def _get_data_extents(fd, size, block_size):
+    # Returns the (start, end) byte ranges of a file that contain data, using
+    # SEEK_DATA/SEEK_HOLE, aligned to block_size. If the filesystem doesn't
+    # support them, the whole file is returned as one range.
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as error:
+                if error.errno == errno.ENXIO:
+                    # There's no data after offset.
+                    break
+                raise
+            offset = os.lseek(fd, start, os.SEEK_HOLE)
+
+            start = start // block_size * block_size
+            end = min(-(-offset // block_size) * block_size, size)
+            if extents and extents[-1][1] >= start:
+                extents[-1] = (extents[-1][0], end)
+            else:
+                extents.append((start, end))
+    except OSError as error:
+        if error.errno != errno.EINVAL:
+            raise
+        extents = [(0, size)]
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    return extents
+
+
+def find_bmap(iso):
+    # bmap files are usually named after the image, with or without its extension.
+    for path in (iso + '.bmap', os.path.splitext(iso)[0] + '.bmap'):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def read_bmap(path):
+    with open(path, mode='rb') as bmap_file:
+        data = bmap_file.read()
+    try:
+        root = xml.etree.ElementTree.fromstring(data)
+        bmap = Bmap(int(root.findtext('ImageSize')), int(root.findtext('BlockSize')),
+                    (root.findtext('ChecksumType') or 'sha1').strip())
+    except (xml.etree.ElementTree.ParseError, TypeError, ValueError):
+        raise ChecksumError(path + ' is not a valid bmap file.')
+
+    # The bmap file checksum is calculated with its own value replaced by zeros.
+    file_checksum = root.findtext('BmapFileChecksum')
+    if file_checksum is not None:
+        file_checksum = file_checksum.strip()
+        hash_object = hashlib.new(bmap.checksum_type)
+        hash_object.update(data.replace(file_checksum.encode(), b'0' * len(file_checksum), 1))
+        if hash_object.hexdigest() != file_checksum:
+            raise ChecksumError(path + ' is corrupted.')
+
+    try:
+        for block_range in root.find('BlockMap').findall('Range'):
+            blocks = block_range.text.strip().split('-')
+            # Version 1 bmap files use a "sha1" attribute instead of "chksum".
+            checksum = block_range.get('chksum', block_range.get('sha1'))
+            bmap.ranges.append((int(blocks[0]), int(blocks[-1]), checksum))
+    except (AttributeError, ValueError):
+        raise ChecksumError(path + ' is not a valid bmap file.')
+
+    return bmap
+
+
+def generate_bmap(image, block_size=BMAP_BLOCK_SIZE, scan_zeros=False, checksum_type='sha256'):
+    # The mapped blocks are the ones that contain data according to
+    # SEEK_DATA/SEEK_HOLE. If scan_zeros is True, blocks that only contain
+    # zeros are left out too, which also works for images that aren't sparse.
+    size = os.path.getsize(image)
+    bmap = Bmap(size, block_size, checksum_type)
+    zeros = bytes(block_size)
+    buffer = bytearray(max(BLOCK_SIZE // block_size, 1) * block_size)
+    view = memoryview(buffer)
+
+    # The range being built, as [first block, last block, hash object].
+    current = None
+
+    def finish_range():
+        nonlocal current
+        if current is not None:
+            bmap.ranges.append((current[0], current[1], current[2].hexdigest()))
+            current = None
+
+    with open(image, 'rb', buffering=0) as file:
+        for start, end in _get_data_extents(file.fileno(), size, block_size):
+            finish_range()
+            file.seek(start)
+            offset = start
+            while offset < end:
+                count = file.readinto(view[:min(len(buffer), end - offset)])
+                if count == 0:
+                    break
+
+                # Consecutive mapped blocks are hashed together.
+                run_start = 0
+                for block_start in range(0, count, block_size):
+                    block = view[block_start:min(block_start + block_size, count)]
+                    if scan_zeros and zeros.startswith(block):
+                        if current is not None:
+                            current[2].update(view[run_start:block_start])
+                        finish_range()
+                        run_start = block_start + block_size
+                        continue
+
+                    index = (offset + block_start) // block_size
+                    if current is None:
+                        current = [index, index, hashlib.new(checksum_type)]
+                        run_start = block_start
+                    else:
+                        current[1] = index
+                if current is not None:
+                    current[2].update(view[run_start:count])
+
+                offset += count
+    finish_range()
+
+    return bmap
+
+
+def _open_device_for_reading(device):
+    # The device is read with O_DIRECT when possible, so the data comes from
+    # the device itself and not from the page cache. Otherwise the buffer
+    # cache of the device is flushed before reading it.
+    try:
+        return os.open('/dev/' + device, os.O_RDONLY | os.O_DIRECT), True
+    except OSError as error:
+        if error.errno != errno.EINVAL:
+            raise
+
+    fd = os.open('/dev/' + device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKFLSBUF)
+    except OSError:
+        # Not a block device (or not allowed to flush it), so at least drop
+        # its clean cached pages.
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return fd, False
+
+
+def _pread_device(fd, direct, view, offset, length):
+    # Reads length bytes at offset into view, which has to be big enough for
+    # length rounded up to ALIGNMENT. Returns the number of bytes read.
+    if direct:
+        # O_DIRECT needs aligned sizes, so read a bit more and drop it.
+        return min(os.preadv(fd, [view[:-(-length // ALIGNMENT) * ALIGNMENT]], offset), length)
+    return os.preadv(fd, [view[:length]], offset)
+
+
+def _read_device(device, extents, block_size=BLOCK_SIZE):
+    # Yields the (start, end) byte ranges of the device in extents, block by
+    # block. The same buffer is reused for every block, so each block has to
+    # be used before asking for the next one.
+    block_size = -(-block_size // ALIGNMENT) * ALIGNMENT
+    buffer = _allocate_buffer(block_size)
+    view = memoryview(buffer)
+    fd, direct = _open_device_for_reading(device)
+    try:
+        for offset, length in _split_extents(extents, block_size):
+            count = _pread_device(fd, direct, view, offset, length)
+            if count < length:
+                raise EOFError('/dev/' + device + ' is smaller than ' + str(offset + length) + ' bytes')
+            yield view[:count]
+    finally:
+        os.close(fd)
+
+
+def _read_file(file, block_size=BLOCK_SIZE, extents=None):
+    # Yields the contents of a file object (or only the byte ranges in
+    # extents), block by block, reusing the same buffer like _read_device.
+    buffer = _allocate_buffer(block_size)
+    view = memoryview(buffer)[:block_size]
+    if extents is None:
+        count = file.readinto(view)
+        while count > 0:
+            yield view[:count]
+            count = file.readinto(view)
+    else:
+        for offset, length in _split_extents(extents, block_size):
+            file.seek(offset)
+            count = file.readinto(view[:length])
+            if count < length:
+                raise EOFError('The image is smaller than ' + str(offset + length) + ' bytes')
+            yield view[:count]
+
+
+def get_hash_algorithms():
+    # The xxHash algorithms need the xxhash module.
+    if xxhash is None:
+        return [algorithm for algorithm in HASH_ALGORITHMS if not algorithm.startswith('xxh')]
+    return list(HASH_ALGORITHMS)
+
+
+def new_hash(algorithm):
+    # Returns a hash object for algorithm, with the same interface as hashlib's.
+    if algorithm == 'crc32':
+        return _CRC32()
+    elif algorithm == 'xxh64':
+        return xxhash.xxh64()
+    elif algorithm == 'xxh3':
+        return xxhash.xxh3_64()
+    return hashlib.new(algorithm)
+
+
+def benchmark_hashes(size=BENCHMARK_SIZE, block_size=BLOCK_SIZE):
+    # Returns the throughput (in bytes per second) of each hash algorithm on
+    # this computer, to choose the one used for verification.
+    block = os.urandom(block_size)
+    results = {}
+    for algorithm in get_hash_algorithms():
+        hash_object = new_hash(algorithm)
+        start = time.perf_counter()
+        for _ in range(max(size // block_size, 1)):
+            hash_object.update(block)
+        hash_object.digest()
+        results[algorithm] = max(size // block_size, 1) * block_size / (time.perf_counter() - start)
+    return results
+
+
+def dd_check(iso, device, block_size=BLOCK_SIZE, progress=None, iso_digest=None, size=None,
+             algorithm=DEFAULT_HASH_ALGORITHM, bmap=None):
+    # Only the part of the device that was written by dd() is read, and with
+    # a bmap only the ranges mapped by it.
+    # algorithm is one of get_hash_algorithms(). If iso_digest (the digest of
+    # the image, as computed by dd() with hash_object) is given, or the digest
+    # of this version of the image is cached, the image itself is not read at
+    # all. The digest of the image is cached for the next calls: a given
+    # iso_digest only once the device matches it, so a wrong one is never
+    # cached.
+    # The image and the device are hashed at the same time, in separate
+    # threads (hashlib releases the GIL while hashing), so this takes about
+    # as long as the slowest of the two reads.
+    # progress is called as progress(bytes_read, bytes_total), where both
+    # values count the bytes read from the image and from the device.
+    # size is the size of the image, see get_image_size().
+    if bmap is not None:
+        if not isinstance(bmap, Bmap):
+            bmap = read_bmap(bmap)
+        extents = bmap.get_extents()
+        size = bmap.get_mapped_size()
+    else:
+        if size is None:
+            size = get_image_size(iso)
+        extents = [(0, size)]
+    given_digest = iso_digest
+    if given_digest is None:
+        iso_digest = get_cached_digest(iso, algorithm, bmap)
+    elif len(given_digest) != new_hash(algorithm).digest_size:
+        raise ValueError('The digest is not a ' + HASH_ALGORITHMS.get(algorithm, algorithm) + ' digest.')
+    if iso_digest is None:
+        total = 2 * size
     else:
+        total = size
+    lock = threading.Lock()
+    done = 0
+
+    def hash_blocks(blocks):
+        nonlocal done
+        hash_object = new_hash(algorithm)
+        for block in blocks:
+            hash_object.update(block)
+            if progress is not None:
+                with lock:
+                    done += len(block)
+                    progress(done, total)
+        return hash_object.digest()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        device_digest = executor.submit(hash_blocks, _read_device(device, extents, block_size))
+        if iso_digest is None:
+            with _open_image(iso) as image:
+                if bmap is None:
+                    iso_digest = executor.submit(hash_blocks, _read_file(image, block_size)).result()
+                else:
+                    iso_digest = executor.submit(hash_blocks, _read_file(image, block_size, extents)).result()
+            _update_cache_entry(iso, digests={_get_digest_name(algorithm, bmap): iso_digest.hex()})
+
+        if device_digest.result() != iso_digest:
+            return False
+    if given_digest is not None:
+        _update_cache_entry(iso, digests={_get_digest_name(algorithm, bmap): iso_digest.hex()})
+    return True
+
+
+def _mismatched_ranges(expected, view, offset):
+    # Compares a block sector by sector and returns the byte ranges of the
+    # sectors that differ, as (start, end) tuples, with start being the
+    # exact offset of the first differing byte.
+    ranges = []
+    for start in range(0, len(view), ALIGNMENT):
+        end = min(start + ALIGNMENT, len(view))
+        if expected[start:end] != view[start:end]:
+            first = start
+            while expected[first] == view[first]:
+                first += 1
+            if ranges and ranges[-1][1] == offset + start:
+                ranges[-1] = (ranges[-1][0], offset + end)
+            else:
+                ranges.append((offset + first, offset + end))
+    return ranges
+
+
+def _compare_block(expected, view, offset, expected_count, count):
+    # Returns the mismatched ranges of a block at offset, of which
+    # expected_count bytes could be read from the image into expected and
+    # count bytes from the device into view. The part of the block that
+    # wasn't read from both is a mismatch too.
+    length = len(expected)
+    compared = min(count, expected_count, length)
+    mismatches = _mismatched_ranges(expected[:compared], view[:compared], offset)
+    if compared < length:
+        if mismatches and mismatches[-1][1] == offset + compared:
+            mismatches[-1] = (mismatches[-1][0], offset + length)
+        else:
+            mismatches.append((offset + compared, offset + length))
+    return mismatches
+
+
+def dd_compare(iso, device, block_size=BLOCK_SIZE, progress=None, stop_on_mismatch=True, size=None):
+    # Compares the image with the device block by block, instead of comparing
+    # digests, so it can stop at the first bad block (if stop_on_mismatch is
+    # True) and report where the device differs from the image.
+    # Blocks that can't be read from the device (unreadable sectors, or past
+    # the end of a device that is too small) are reported as mismatches too.
+    # progress is called as progress(bytes_compared, bytes_total).
+    # size is the size of the image, see get_image_size().
+    if size is None:
+        size = get_image_size(iso)
+    block_size = -(-block_size // ALIGNMENT) * ALIGNMENT
+    result = CompareResult(size)
+
+    # The image is read into a bytearray, as bytearray.startswith() compares
+    # it with the device's memoryview without copying either of them.
+    expected = bytearray(block_size)
+    expected_view = memoryview(expected)
+    buffer = _allocate_buffer(block_size)
+    view = memoryview(buffer)
+
+    fd, direct = _open_device_for_reading(device)
+    try:
+        with _open_image(iso) as source, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            while result.compared < size:
+                offset = result.compared
+                length = min(block_size, size - offset)
+                # The next image block is read while the device block is read.
+                future = executor.submit(source.readinto, expected_view[:length])
+                try:
+                    count = _pread_device(fd, direct, view, offset, length)
+                except OSError:
+                    count = 0
+                expected_count = future.result()
+
+                if count != length or expected_count != length or not expected.startswith(view[:length]):
+                    mismatches = _compare_block(expected_view[:length], view, offset, expected_count, count)
+                    if result.mismatches and result.mismatches[-1][1] == mismatches[0][0]:
+                        # Consecutive bad blocks are one region.
+                        result.mismatches[-1] = (result.mismatches[-1][0], mismatches.pop(0)[1])
+                    result.mismatches += mismatches
+                    if stop_on_mismatch:
+                        result.compared += length
+                        break
+
+                result.compared += length
+                if progress is not None:
+                    progress(result.compared, size)
+    finally:
+        os.close(fd)
+
+    return result
+
+
+def dd_check_sampled(iso, device, coverage=SAMPLE_COVERAGE, seed=None, block_size=SAMPLE_BLOCK_SIZE, progress=None,
+                     size=None, bmap=None):
+    # Compares a random sample of the blocks of the image with the device,
+    # which is much faster than dd_check() but only finds damage that
+    # affects a good part of the device.
+    # coverage is the fraction of the blocks that are compared. The blocks
+    # are chosen by a random.Random(seed), so the same seed compares the
+    # same blocks again. If seed is None, a random one is used. Both are
+    # reported in the returned SampleResult.
+    # With a bmap, only its mapped ranges are sampled.
+    # progress is called as progress(bytes_compared, bytes_total).
+    # size is the size of the image, see get_image_size().
+    block_size = -(-block_size // ALIGNMENT) * ALIGNMENT
+    if bmap is not None:
+        if not isinstance(bmap, Bmap):
+            bmap = read_bmap(bmap)
+        extents = bmap.get_extents()
+    else:
+        if size is None:
+            size = get_image_size(iso)
+        extents = [(0, size)]
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+
+    blocks = list(_split_extents(extents, block_size))
+    edge_end = blocks[-1][0] + blocks[-1][1] if blocks else 0
+    edges = set(index for index, (offset, length) in enumerate(blocks)
+                if offset < SAMPLE_EDGE or offset + length > edge_end - SAMPLE_EDGE)
+    others = [index for index in range(len(blocks)) if index not in edges]
+    count = min(int(round(len(blocks) * coverage)), len(blocks))
+    sampled = edges.union(random.Random(seed).sample(others, max(count - len(edges), 0)))
+    # The blocks are read in order, so compressed images can be read too.
+    sample = [blocks[index] for index in sorted(sampled)]
+
+    result = SampleResult(seed, coverage, len(blocks), len(sample))
+    total = sum(length for offset, length in sample)
+    buffer = _allocate_buffer(block_size)
+    view = memoryview(buffer)
+    expected = bytearray(block_size)
+    expected_view = memoryview(expected)
+    fd, direct = _open_device_for_reading(device)
+    try:
+        with _open_image(iso) as source:
+            for offset, length in sample:
+                source.seek(offset)
+                expected_count = source.readinto(expected_view[:length])
+                try:
+                    count = _pread_device(fd, direct, view, offset, length)
+                except OSError:
+                    count = 0
+                # A short read (a device smaller than the image) leaves the
+                # rest of the block unverified, so it's a mismatch too.
+                if expected_count != length or count != length or not expected.startswith(view[:length]):
+                    result.mismatches += _compare_block(expected_view[:length], view, offset, expected_count, count)
+                result.compared += length
+                if progress is not None:
+                    progress(result.compared, total)
+    finally:
+        os.close(fd)
+
+    return result
+
+
+def generate_index(iso, chunk_size=INDEX_CHUNK_SIZE, algorithm=INDEX_ALGORITHM, threads=None, progress=None):
+    # Returns an ImageIndex with the digest of every chunk_size bytes of the
+    # image (decompressed, for compressed images). The image is read once,
+    # and the chunks are hashed by threads threads (one per CPU by default).
+    # progress is called as progress(bytes_hashed, bytes_total), where
+    # bytes_total is the size of the image file.
+    threads = threads or os.cpu_count() or 1
+    stat = os.stat(iso)
+    index = ImageIndex(0, chunk_size, algorithm, stat.st_size, stat.st_mtime_ns)
+
+    def hash_chunk(chunk):
+        hash_object = new_hash(algorithm)
+        hash_object.update(chunk)
+        return hash_object.hexdigest()
+
+    with _open_image(iso) as image, concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        # At most 2 * threads chunks are in memory at once.
+        pending = collections.deque()
+        while True:
+            chunk = bytearray(chunk_size)
+            count = 0
+            while count < chunk_size:
+                # Decompressed images can return less than asked for.
+                read = image.readinto(memoryview(chunk)[count:])
+                if read == 0:
+                    break
+                count += read
+            del chunk[count:]
+            if chunk:
+                index.image_size += len(chunk)
+                pending.append(executor.submit(hash_chunk, chunk))
+            if pending and (not chunk or len(pending) >= 2 * threads):
+                index.digests.append(pending.popleft().result())
+                if progress is not None:
+                    if get_compression(iso) is not None:
+                        progress(image.consumed, image.size)
+                    else:
+                        progress(min(len(index.digests) * chunk_size, index.image_size), stat.st_size)
+            elif not chunk:
+                break
+
+    return index
+
+
+def find_index(iso):
+    path = iso + INDEX_EXTENSION
+    if os.path.isfile(path):
+        return path
+    return None
+
+
+def read_index(path):
+    with open(path, mode='r', encoding='utf_8') as index_file:
+        data = json.load(index_file)
+    index = ImageIndex(data['image_size'], data['chunk_size'], data['algorithm'], data['source_size'],
+                       data['source_mtime_ns'])
+    index.digests = data['digests']
+    if index.get_root() != data['root']:
+        raise ChecksumError(path + ' is corrupted.')
+    return index
+
+
+def get_index(iso, progress=None):
+    # Returns the index of the image, from its sidecar file if it's up to
+    # date, or otherwise generating it (and saving it next to the image, if
+    # possible).
+    path = find_index(iso)
+    if path is not None:
+        try:
+            index = read_index(path)
+        except (OSError, ValueError, KeyError, ChecksumError):
+            index = None
+        if index is not None and index.matches(iso):
+            return index
+
+    index = generate_index(iso, progress=progress)
+    try:
+        index.write(iso + INDEX_EXTENSION)
+    except OSError:
+        pass
+    return index
+
+
+def dd_check_index(index, device, threads=None, progress=None):
+    # Compares the device with an ImageIndex (see get_index()), without
+    # reading the image. The chunks of the device are read and hashed by
+    # threads threads (one per CPU by default), and every chunk whose digest
+    # differs, or that can't be read (an unreadable sector, for example), is
+    # reported as a mismatch in the returned CompareResult.
+    # progress is called as progress(bytes_checked, bytes_total).
+    threads = threads or os.cpu_count() or 1
+    result = CompareResult(index.image_size)
+    lock = threading.Lock()
+    local = threading.local()
+    fd, direct = _open_device_for_reading(device)
+
+    def check_chunk(number):
+        if not hasattr(local, 'view'):
+            local.view = memoryview(_allocate_buffer(-(-index.chunk_size // ALIGNMENT) * ALIGNMENT))
+        offset = number * index.chunk_size
+        length = min(index.chunk_size, index.image_size - offset)
+        try:
+            count = _pread_device(fd, direct, local.view, offset, length)
+        except OSError:
+            count = 0
+        hash_object = new_hash(index.algorithm)
+        hash_object.update(local.view[:count])
+        with lock:
+            result.compared += length
+            if count != length or hash_object.hexdigest() != index.digests[number]:
+                result.mismatches.append((offset, offset + length))
+            if progress is not None:
+                progress(result.compared, result.size)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(check_chunk, number) for number in range(len(index.digests))]:
+                future.result()
+    finally:
+        os.close(fd)
+
+    result.mismatches.sort()
+    return result
+
+
+class CompareResult:
+    def __init__(self, size):
+        self.size = size
+        # Number of bytes of the image that were compared.
+        self.compared = 0
+        # Byte ranges where the device differs from the image, as (start, end) tuples.
+        self.mismatches = []
+
+    def is_ok(self):
+        return self.compared == self.size and not self.mismatches
+
+    def get_first_mismatch(self):
+        if self.mismatches:
+            return self.mismatches[0][0]
+        return None
+
+    def get_bad_bytes(self):
+        return sum(end - start for start, end in self.mismatches)
+
+    def __str__(self):
+        if self.is_ok():
+            return 'The device matches the image (' + str(self.size) + ' bytes).'
+        elif not self.mismatches:
+            return 'Only ' + str(self.compared) + ' of ' + str(self.size) + ' bytes were compared.'
+        return 'The device differs from the image in ' + str(len(self.mismatches)) + ' region(s) (' + \
+            str(self.get_bad_bytes()) + ' bytes), starting at byte ' + str(self.get_first_mismatch()) + '.'
+
+
+class SampleResult:
+    def __init__(self, seed, coverage, blocks, sampled):
+        # The seed and coverage that dd_check_sampled() was called with, so
+        # the same check can be repeated.
+        self.seed = seed
+        self.coverage = coverage
+        # Number of blocks of the image, and number of them that were compared.
+        self.blocks = blocks
+        self.sampled = sampled
+        # Number of bytes compared.
+        self.compared = 0
+        # Byte ranges where the device differs from the image, as (start, end) tuples.
+        self.mismatches = []
+
+    def is_ok(self):
+        return not self.mismatches
+
+    def get_first_mismatch(self):
+        if self.mismatches:
+            return self.mismatches[0][0]
+        return None
+
+    def __str__(self):
+        sample = str(self.sampled) + ' of ' + str(self.blocks) + ' blocks (coverage ' + str(self.coverage) + \
+            ', seed ' + str(self.seed) + ')'
+        if self.is_ok():
+            return 'The device matches the image in ' + sample + '.'
+        return 'The device differs from the image in ' + str(len(self.mismatches)) + ' region(s) of ' + sample + \
+            ', starting at byte ' + str(self.get_first_mismatch()) + '.'
+
+
+class _Stage:
+    # An image loaded into a memfd, and mapped into memory.
+    def __init__(self, iso, size, hugepages, limit):
+        # size is the size of the image, or None if it isn't known (a
+        # compressed image whose size isn't cached), in which case the image is
+        # decompressed into the memfd as it comes. _StageTooBig is raised if the
+        # image turns out to be bigger than limit.
+        self.fd = None
+        if size is None:
+            self._load_unknown_size(iso, limit)
+            return
+
+        if hugepages:
+            try:
+                self.fd = os.memfd_create('usbmaker', os.MFD_CLOEXEC | os.MFD_HUGETLB)
+                # Huge page backed files can only have whole pages.
+                self.length = -(-max(size, 1) // HUGE_PAGE_SIZE) * HUGE_PAGE_SIZE
+                os.ftruncate(self.fd, self.length)
+                self.map = mmap.mmap(self.fd, self.length)
+            except (OSError, AttributeError):
+                # No huge pages were reserved, for example.
+                if self.fd is not None:
+                    os.close(self.fd)
+                self.fd = None
+        if self.fd is None:
+            self.fd = os.memfd_create('usbmaker', os.MFD_CLOEXEC)
+            self.length = max(size, 1)
+            os.ftruncate(self.fd, self.length)
+            self.map = mmap.mmap(self.fd, self.length)
+        self.size = size
+
+        view = memoryview(self.map)
+        position = 0
+        with _open_image_file(iso) as image:
+            while position < size:
+                count = image.readinto(view[position:min(position + BLOCK_SIZE, size)])
+                if count == 0:
+                    raise EOFError(iso + ' is smaller than ' + str(size) + ' bytes')
+                position += count
+
+    def _load_unknown_size(self, iso, limit):
+        # The memfd is appended to, which huge page backed files don't
+        # support, so normal pages are used. The image is only decompressed
+        # once, and its size is cached for the next time.
+        self.fd = os.memfd_create('usbmaker', os.MFD_CLOEXEC)
+        buffer = _allocate_buffer(BLOCK_SIZE)
+        view = memoryview(buffer)[:BLOCK_SIZE]
+        size = 0
+        with _open_image_file(iso) as image:
+            count = image.readinto(view)
+            while count > 0:
+                size += count
+                if size > limit:
+                    raise _StageTooBig()
+                _write_all(self.fd, view[:count], size - count)
+                count = image.readinto(view)
+        self.size = size
+        self.length = max(size, 1)
+        os.ftruncate(self.fd, self.length)
+        self.map = mmap.mmap(self.fd, self.length)
+        _update_cache_entry(iso, image_size=size)
+
+    def __del__(self):
+        # The memory itself is freed with the map, once no view uses it.
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class _StagingCache:
+    def __init__(self, budget, hugepages):
+        self.budget = budget
+        self.hugepages = hugepages
+        # _Stage of each image, by (st_dev, st_ino, size, mtime_ns), least
+        # recently used first.
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _evict(self, size):
+        # Drops the least recently used images until size more bytes fit in
+        # the budget. Images that are still being read stay in memory until
+        # they're closed.
+        while self.stages and sum(stage.length for stage in self.stages.values()) + size > self.budget:
+            self.stages.popitem(last=False)
+
+    def get(self, iso):
+        # Returns the _Stage of the image, loading it if needed, or None if it
+        # doesn't fit in the budget.
+        stat = os.stat(iso)
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.stages:
+                self.stages.move_to_end(key)
+                return self.stages[key]
+
+            # Older versions of the same file won't be used again.
+            for other_key in [other_key for other_key in self.stages if other_key[:2] == key[:2]]:
+                del self.stages[other_key]
+
+            # The size of compressed images is only known if it was cached.
+            # Otherwise the image is staged first, and room is made for it
+            # afterwards.
+            if get_compression(iso) is None:
+                size = stat.st_size
+            else:
+                size = _get_cache_entry(iso).get('image_size')
+            if size is not None:
+                if size > self.budget:
+                    return None
+                self._evict(size)
+
+            try:
+                stage = _Stage(iso, size, self.hugepages, self.budget)
+            except _StageTooBig:
+                return None
+            if size is None:
+                self._evict(stage.length)
+            self.stages[key] = stage
+            return stage
+
+
+class _StagedImage:
+    # A file-like object (readinto(), seek() and close()) that reads a staged
+    # image. get_view() returns its blocks without copying them.
+    def __init__(self, stage):
+        self._stage = stage
+        self._view = memoryview(stage.map)[:stage.size]
+        self.size = stage.size
+        self.position = 0
+
+    @property
+    def consumed(self):
+        # Like _DecompressingReader, for the progress of compressed images.
+        return self.position
+
+    def get_view(self, offset, length):
+        self.position = min(offset + length, self.size)
+        return self._view[offset:self.position]
+
+    def readinto(self, view):
+        block = self.get_view(self.position, len(view))
+        view[:len(block)] = block
+        return len(block)
+
+    def seek(self, offset):
+        self.position = offset
+        return offset
+
+    def fileno(self):
+        return self._stage.fd
+
+    def close(self):
+        self._view = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _CRC32:
+    # hashlib-like interface for zlib.crc32, which releases the GIL too.
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, 'big')
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+class _DecompressingReader:
+    # A file-like object (readinto(), forward seek() and close()) that returns
+    # the decompressed contents of a compressed image. The image is
+    # decompressed by a background thread, which stays at most
+    # DECOMPRESS_QUEUE_SIZE chunks ahead of the reader.
+    # xz and zstd images are decompressed by their command line tools when they
+    # are installed. xz decompresses multi-block images with several threads
+    # (-T0), which Python's lzma module can't do.
+    def __init__(self, path, compression):
+        if compression == 'zstd' and shutil.which('zstd') is None:
+            # Python has no zstd decompressor.
+            raise OSError('"zstd" was not found. Install it to write .zst images.')
+        self.size = os.path.getsize(path)
+        # Number of compressed bytes consumed so far.
+        self.consumed = 0
+        self.position = 0
+
+        self._queue = queue.Queue(maxsize=DECOMPRESS_QUEUE_SIZE)
+        self._closed = False
+        self._finished = False
+        self._chunk = memoryview(b'')
+
+        self._file = open(path, 'rb', buffering=0)
+        self._process = None
+        try:
+            if compression == 'xz' and shutil.which('xz') is not None:
+                self._process = subprocess.Popen(['xz', '--decompress', '--stdout', '--threads=0'],
+                                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            elif compression == 'zstd':
+                self._process = subprocess.Popen(['zstd', '--decompress', '--stdout'],
+                                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError:
+            self._file.close()
+            raise
+
+        if self._process is not None:
+            # The compressed data is fed to the process by another thread, so
+            # the consumed bytes can be counted.
+            self._feeder = threading.Thread(target=self._feed, daemon=True)
+            self._feeder.start()
+            self._stream = self._process.stdout
+        elif compression == 'xz':
+            self._stream = lzma.open(self._file)
+        elif compression == 'gzip':
+            self._stream = gzip.open(self._file)
+        else:
+            self._stream = bz2.open(self._file)
+
+        self._thread = threading.Thread(target=self._decompress, daemon=True)
+        self._thread.start()
+
+    def _feed(self):
+        try:
+            data = self._file.read(DECOMPRESS_CHUNK_SIZE)
+            while data and not self._closed:
+                self._process.stdin.write(data)
+                self.consumed += len(data)
+                data = self._file.read(DECOMPRESS_CHUNK_SIZE)
+        except (BrokenPipeError, ValueError):
+            # The process exited (or the reader was closed) before reading everything.
+            pass
+        finally:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _put(self, item):
+        # Waits for space in the queue, unless the reader is closed.
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
         return False
+
+    def _decompress(self):
+        try:
+            chunk = self._stream.read(DECOMPRESS_CHUNK_SIZE)
+            while chunk:
+                if self._process is None:
+                    self.consumed = self._file.tell()
+                if not self._put(chunk):
+                    return
+                chunk = self._stream.read(DECOMPRESS_CHUNK_SIZE)
+
+            if self._process is not None and self._process.wait() != 0:
+                raise OSError('Could not decompress ' + self._file.name + ' (' + self._process.args[0] +
+                              ' returned ' + str(self._process.returncode) + ').')
+            self.consumed = self.size
+            self._put(None)
+        except (lzma.LZMAError, zlib.error, EOFError, ValueError) as error:
+            # A corrupt or truncated image. The errors of the decompressors
+            # aren't OSErrors, which is what the callers handle.
+            message = str(error) or type(error).__name__
+            self._put(OSError('Could not decompress ' + self._file.name + ' (' + message + ').'))
+        except Exception as error:
+            self._put(error)
+
+    def readinto(self, view):
+        # Fills the whole view, unless the end of the image is reached.
+        filled = 0
+        while filled < len(view) and not self._finished:
+            if not self._chunk:
+                item = self._queue.get()
+                if item is None:
+                    self._finished = True
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                self._chunk = memoryview(item)
+
+            count = min(len(self._chunk), len(view) - filled)
+            view[filled:filled + count] = self._chunk[:count]
+            self._chunk = self._chunk[count:]
+            filled += count
+
+        self.position += filled
+        return filled
+
+    def seek(self, offset):
+        # Only forward seeks are possible, by skipping data.
+        if offset < self.position:
+            raise OSError(errno.ESPIPE, 'Can not seek backwards in a compressed image')
+        buffer = bytearray(min(offset - self.position, DECOMPRESS_CHUNK_SIZE))
+        while self.position < offset:
+            if self.readinto(memoryview(buffer)[:offset - self.position]) == 0:
+                break
+        return self.position
+
+    def close(self):
+        self._closed = True
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+        self._thread.join()
+        self._stream.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DeviceResult:
+    def __init__(self, device):
+        self.device = device
+        # Number of bytes written to the device.
+        self.written = 0
+        # The exception that stopped the write, if any.
+        self.error = None
+
+    def is_ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.is_ok():
+            return self.device + ': ' + str(self.written) + ' bytes written.'
+        return self.device + ': ' + str(self.error)
+
+
+class _ReadbackVerifier:
+    # Keeps copies of the image blocks given to add(), in order, and compares
+    # them with the device once they're lag bytes behind the end given to
+    # verify().
+    def __init__(self, device, write_fd, block_size, lag):
+        self.write_fd = write_fd
+        self.lag = lag
+        self.blocks = collections.deque()
+        self.fd, self.direct = _open_device_for_reading(device)
+        self.buffer = _allocate_buffer(block_size)
+
+    def add(self, view, offset):
+        self.blocks.append((offset, bytearray(view)))
+
+    def verify(self, end=None):
+        # Verifies the blocks that end lag bytes before end, or all of them
+        # if end is None.
+        view = memoryview(self.buffer)
+        while self.blocks and (end is None or self.blocks[0][0] + len(self.blocks[0][1]) <= end - self.lag):
+            offset, expected = self.blocks.popleft()
+            length = len(expected)
+            writeback.wait_writeback(self.write_fd, offset, length)
+            if not self.direct:
+                writeback.drop_cache(self.fd, offset, length)
+            count = _pread_device(self.fd, self.direct, view, offset, length)
+            if count != length or not expected.startswith(view[:length]):
+                # A short read leaves the rest of the block unverified.
+                raise VerifyError(_mismatched_ranges(memoryview(expected), view[:count], offset) or
+                                  [(offset + count, offset + length)])
+
+    def close(self):
+        os.close(self.fd)
+
+
+class VerifyError(Exception):
+    def __init__(self, mismatches):
+        super(VerifyError, self).__init__('The device differs from the image at byte ' + str(mismatches[0][0]))
+        # Byte ranges where the device differs from the image, as (start, end) tuples.
+        self.mismatches = mismatches
+
+
+class WriteError(Exception):
+    def __init__(self, offset, error):
+        super(WriteError, self).__init__('Could not write at byte ' + str(offset) + ': ' + str(error))
+        # Everything before offset is known to have been written.
+        self.offset = offset
+        self.error = error
+
+
+class Bmap:
+    def __init__(self, image_size, block_size=BMAP_BLOCK_SIZE, checksum_type='sha256'):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.checksum_type = checksum_type
+        # The mapped blocks, as (first block, last block, checksum) tuples.
+        self.ranges = []
+
+    def get_extents(self):
+        return [(first * self.block_size, min((last + 1) * self.block_size, self.image_size))
+                for first, last, checksum in self.ranges]
+
+    def get_mapped_size(self):
+        return sum(end - start for start, end in self.get_extents())
+
+    def write(self, path):
+        # Same format as the bmap files created by bmaptool (version 2.0).
+        mapped_blocks = sum(last - first + 1 for first, last, checksum in self.ranges)
+        zero_checksum = '0' * hashlib.new(self.checksum_type).digest_size * 2
+        lines = ['<?xml version="1.0" ?>',
+                 '<bmap version="2.0">',
+                 '    <ImageSize> ' + str(self.image_size) + ' </ImageSize>',
+                 '    <BlockSize> ' + str(self.block_size) + ' </BlockSize>',
+                 '    <BlocksCount> ' + str(-(-self.image_size // self.block_size)) + ' </BlocksCount>',
+                 '    <MappedBlocksCount> ' + str(mapped_blocks) + ' </MappedBlocksCount>',
+                 '    <ChecksumType> ' + self.checksum_type + ' </ChecksumType>',
+                 '    <BmapFileChecksum> ' + zero_checksum + ' </BmapFileChecksum>',
+                 '    <BlockMap>']
+        for first, last, checksum in self.ranges:
+            if first == last:
+                blocks = str(first)
+            else:
+                blocks = str(first) + '-' + str(last)
+            lines.append('        <Range chksum="' + checksum + '"> ' + blocks + ' </Range>')
+        lines += ['    </BlockMap>', '</bmap>', '']
+        data = '\n'.join(lines).encode()
+
+        hash_object = hashlib.new(self.checksum_type)
+        hash_object.update(data)
+        data = data.replace(zero_checksum.encode(), hash_object.hexdigest().encode(), 1)
+
+        with open(path, mode='wb') as bmap_file:
+            bmap_file.write(data)
+
+
+class ImageIndex:
+    def __init__(self, image_size, chunk_size=INDEX_CHUNK_SIZE, algorithm=INDEX_ALGORITHM, source_size=None,
+                 source_mtime_ns=None):
+        self.image_size = image_size
+        self.chunk_size = chunk_size
+        self.algorithm = algorithm
+        # Size and modification time of the image file the index was made
+        # from, to tell when it's out of date.
+        self.source_size = source_size
+        self.source_mtime_ns = source_mtime_ns
+        # Hex digest of each chunk of the image.
+        self.digests = []
+
+    def get_root(self):
+        # Digest of all the chunk digests, which identifies the whole image.
+        hash_object = new_hash(self.algorithm)
+        for digest in self.digests:
+            hash_object.update(bytes.fromhex(digest))
+        return hash_object.hexdigest()
+
+    def matches(self, iso):
+        stat = os.stat(iso)
+        return stat.st_size == self.source_size and stat.st_mtime_ns == self.source_mtime_ns
+
+    def write(self, path):
+        data = {'version': 1, 'image_size': self.image_size, 'chunk_size': self.chunk_size,
+                'algorithm': self.algorithm, 'source_size': self.source_size,
+                'source_mtime_ns': self.source_mtime_ns, 'root': self.get_root(), 'digests': self.digests}
+        _write_json_atomically(path, data)
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class _StageTooBig(Exception):
+    pass
@@ -11,7 +11,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 class Ui_MainWindow(object):
     def setupUi(self, MainWindow):
         MainWindow.setObjectName("MainWindow")
-        MainWindow.resize(363, 482)
+        MainWindow.resize(363, 512)
         MainWindow.setMinimumSize(QtCore.QSize(363, 0))
         self.centralWidget = QtWidgets.QWidget(MainWindow)
         self.centralWidget.setObjectName("centralWidget")
@@ -109,6 +109,27 @@ class Ui_MainWindow(object):
         self.pushButton_filedialog.setObjectName("pushButton_filedialog")
         self.horizontalLayout_3.addWidget(self.pushButton_filedialog)
         self.verticalLayout_3.addLayout(self.horizontalLayout_3)
+        self.horizontalLayout_5 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_5.setObjectName("horizontalLayout_5")
+        self.checkBox_verify = QtWidgets.QCheckBox(self.frame)
+        font = QtGui.QFont()
+        font.setPointSize(9)
+        self.checkBox_verify.setFont(font)
+        self.checkBox_verify.setObjectName("checkBox_verify")
+        self.horizontalLayout_5.addWidget(self.checkBox_verify)
+        self.comboBox_verify = QtWidgets.QComboBox(self.frame)
+        font = QtGui.QFont()
+        font.setPointSize(9)
+        self.comboBox_verify.setFont(font)
+        self.comboBox_verify.setObjectName("comboBox_verify")
+        self.horizontalLayout_5.addWidget(self.comboBox_verify)
+        self.verticalLayout_3.addLayout(self.horizontalLayout_5)
+        self.checkBox_staging = QtWidgets.QCheckBox(self.frame)
+        font = QtGui.QFont()
+        font.setPointSize(9)
+        self.checkBox_staging.setFont(font)
+        self.checkBox_staging.setObjectName("checkBox_staging")
+        self.verticalLayout_3.addWidget(self.checkBox_staging)
         self.verticalLayout.addWidget(self.frame)
         self.progressBar = QtWidgets.QProgressBar(self.centralWidget)
         self.progressBar.setProperty("value", 0)
@@ -173,6 +194,8 @@ class Ui_MainWindow(object):
         self.checkBox_checkbadblocks.setText(_translate("MainWindow", "Check device for bad blocks"))
         self.checkBox_bootmethod.setText(_translate("MainWindow", "Create a bootable disk using"))
         self.pushButton_filedialog.setText(_translate("MainWindow", "..."))
+        self.checkBox_verify.setText(_translate("MainWindow", "Verify the written image using"))
+        self.checkBox_staging.setText(_translate("MainWindow", "Keep the image in memory for the next writes"))
         self.pushButton_about.setText(_translate("MainWindow", "About..."))
         self.pushButton_start.setText(_translate("MainWindow", "Start"))
         self.pushButton_close.setText(_translate("MainWindow", "Close"))
@@ -16,61 +16,514 @@
 #   along with USBMaker.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import distutils.dir_util
+import struct
+import collections
+import threading
+import errno
+import functools
+import concurrent.futures
+import stat
+import fcntl
 import subprocess
 import shutil
 import platform
+import writeback
+import mount
 
-# os.symlink raises a PermissionError when creating symlinks
-# on filesystems that don't support them (FAT32, for example).
-#
-# This function is overriden so the program continues executing
-# when this exception is raised. This is preferred to setting
-# preserve_symlinks=0 in the distutils.dir_util.copy_tree function
-# because it also avoids recursive symlinks.
-orig_symlink = os.symlink
 
+def _exists(iso, path):
+    # iso is the mount point of the iso file, or an IsoImage.
+    if isinstance(iso, IsoImage):
+        return iso.exists(path)
+    return os.path.exists(iso + path)
+
+
+def _isfile(iso, path):
+    if isinstance(iso, IsoImage):
+        return iso.isfile(path)
+    return os.path.isfile(iso + path)
+
+
+def is_udf(iso):
+    # UDF images have a volume recognition sequence (BEA01, NSR02 or NSR03,
+    # TEA01) after their ISO 9660 volume descriptors, if they have any. The
+    # ISO 9660 tree of UDF bridge images, like the Windows installers, often
+    # only has a README, so the UDF tree has to be read by loop mounting them.
+    with open(iso, 'rb') as iso_file:
+        sector = ISO_FIRST_DESCRIPTOR
+        while True:
+            iso_file.seek(sector * ISO_SECTOR_SIZE)
+            identifier = iso_file.read(ISO_SECTOR_SIZE)[1:6]
+            if identifier in UDF_IDENTIFIERS:
+                return True
+            elif identifier not in VOLUME_RECOGNITION_IDENTIFIERS:
+                return False
+            sector += 1
 
-def _symlink(source, link_name, target_is_directory=False, dir_fd=None):
-    try:
-        orig_symlink(source, link_name, target_is_directory=target_is_directory, dir_fd=dir_fd)
-    except PermissionError:
-        pass
 
-# This makes any function (distutils.dir_util.copy_tree in particular)
-# that uses os.symlink use the _symlink function instead:
-# os.symlink = _symlink
+def has_uefi_bootloader(iso_mountpoint):
+    return _isfile(iso_mountpoint, '/boot/efi/bootx64.efi') or _isfile(iso_mountpoint, '/boot/efi/bootia32.efi')
 
 
 def get_bios_bootloader_name(iso_mountpoint):
-    if os.path.exists(iso_mountpoint + '/boot/isolinux') or os.path.exists(iso_mountpoint + '/boot/syslinux') or \
-       os.path.exists(iso_mountpoint + '/syslinux') or os.path.exists(iso_mountpoint + '/isolinux') or \
-       os.path.exists(iso_mountpoint + '/syslinux.cfg') or os.path.exists(iso_mountpoint + '/isolinux.cfg'):
+    if _exists(iso_mountpoint, '/boot/isolinux') or _exists(iso_mountpoint, '/boot/syslinux') or \
+       _exists(iso_mountpoint, '/syslinux') or _exists(iso_mountpoint, '/isolinux') or \
+       _exists(iso_mountpoint, '/syslinux.cfg') or _exists(iso_mountpoint, '/isolinux.cfg'):
         return 'syslinux'
-    elif os.path.exists(iso_mountpoint + '/grldr') or os.path.exists(iso_mountpoint + '/menu.lst'):
+    elif _exists(iso_mountpoint, '/grldr') or _exists(iso_mountpoint, '/menu.lst'):
         return 'grub4dos'
     else:
         return 'unknown'
 
 
 def get_uefi_bootloader_name(iso_mountpoint):
-    if os.path.exists(iso_mountpoint + '/boot/grub/grub.cfg') or \
-            os.path.exists(iso_mountpoint + '/efi/boot/grub.cfg'):
+    if _exists(iso_mountpoint, '/boot/grub/grub.cfg') or \
+            _exists(iso_mountpoint, '/efi/boot/grub.cfg'):
         return 'grub2'
-    elif os.path.exists(iso_mountpoint + '/loader/loader.conf'):
+    elif _exists(iso_mountpoint, '/loader/loader.conf'):
         return 'systemd-boot'
-    elif os.path.exists(iso_mountpoint + '/boot/isolinux') or os.path.exists(iso_mountpoint + '/boot/syslinux') or \
-            os.path.exists(iso_mountpoint + '/syslinux') or os.path.exists(iso_mountpoint + '/isolinux') or \
-            os.path.exists(iso_mountpoint + '/syslinux.cfg') or os.path.exists(iso_mountpoint + '/isolinux.cfg'):
+    elif _exists(iso_mountpoint, '/boot/isolinux') or _exists(iso_mountpoint, '/boot/syslinux') or \
+            _exists(iso_mountpoint, '/syslinux') or _exists(iso_mountpoint, '/isolinux') or \
+            _exists(iso_mountpoint, '/syslinux.cfg') or _exists(iso_mountpoint, '/isolinux.cfg'):
         return 'syslinux'
     else:
         return 'unknown'
 
 
-def copy_iso_contents(iso_mountpoint, device_mountpoint):
-    os.symlink = _symlink
-    distutils.dir_util.copy_tree(iso_mountpoint, device_mountpoint, preserve_symlinks=1)
-    os.sync()
+# FAT can't store files of 4 GiB or more.
+FAT_FILESYSTEMS = ('vfat', 'msdos', 'fat32', 'fat16')
+FAT_MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024 - 1
+
+# Files are copied in blocks of this size, by up to COPY_THREADS threads.
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+COPY_THREADS = 4
+# fcntl.F_SETPIPE_SZ, which is only in the fcntl module since Python 3.10.
+F_SETPIPE_SZ = 1031
+
+# ISO 9660 constants.
+ISO_SECTOR_SIZE = 2048
+ISO_FIRST_DESCRIPTOR = 16
+ISO_DIRECTORY_FLAG = 0x02
+ISO_ASSOCIATED_FLAG = 0x04
+ISO_MULTI_EXTENT_FLAG = 0x80
+ISO_BLOCK_SIZES = (512, 1024, 2048)
+ISO_RECORD_HEADER_SIZE = 33
+# Smallest valid lengths of the SUSP entries that are read.
+SUSP_MIN_LENGTHS = {b'CE': 28, b'PX': 8, b'CL': 8, b'NM': 5, b'SL': 5}
+JOLIET_ESCAPE_SEQUENCES = (b'%/@', b'%/C', b'%/E')
+
+# Identifiers of the descriptors that can come before the UDF ones, and of the
+# UDF descriptors themselves.
+VOLUME_RECOGNITION_IDENTIFIERS = (b'CD001', b'BEA01', b'BOOT2', b'CDW02')
+UDF_IDENTIFIERS = (b'NSR02', b'NSR03')
+
+
+def _can_symlink(directory):
+    # Filesystems like FAT32 and exFAT can't store symlinks.
+    path = os.path.join(directory, '.usbmaker-symlink-test')
+    try:
+        os.symlink('.', path)
+    except OSError:
+        return False
+    os.remove(path)
+    return True
+
+
+def _copy_metadata(file_stat, destination):
+    # Copies the permissions and times that the destination's filesystem can
+    # store.
+    try:
+        os.chmod(destination, file_stat.st_mode & 0o7777)
+    except OSError:
+        pass
+    try:
+        os.utime(destination, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+    except OSError:
+        pass
+
+
+def _get_copy_methods(source_fd, destination_fd):
+    # Returns the ways of copying from source_fd (a regular file) to
+    # destination_fd, best first, chosen by what they are and where they are
+    # stored: os.copy_file_range() between files on the same filesystem
+    # (across filesystems, recent kernels refuse it or do the same as
+    # sendfile), os.splice() into pipes, and os.sendfile() otherwise. Reading
+    # into a buffer is always the last one, in case the kernel can't copy.
+    destination_stat = os.fstat(destination_fd)
+    methods = ['sendfile', 'buffer']
+    if stat.S_ISFIFO(destination_stat.st_mode):
+        if hasattr(os, 'splice'):
+            methods.insert(0, 'splice')
+    elif os.fstat(source_fd).st_dev == destination_stat.st_dev and hasattr(os, 'copy_file_range'):
+        methods.insert(0, 'copy_file_range')
+    return methods
+
+
+def _copy_data(source_fd, offset, length, destination_fd, destination_writeback, position, methods=None):
+    # Copies length bytes from offset of source_fd to the end of
+    # destination_fd (at position), in COPY_BUFFER_SIZE blocks, and returns
+    # the new position. The copy stops early at the end of the source.
+    # The data is copied with the methods from _get_copy_methods(), and if
+    # one fails, the next one is used from then on (methods, if given, is
+    # updated, so copies between the same files don't try it again).
+    # The copy is written back every writeback.SYNC_INTERVAL bytes (unless
+    # destination_writeback is None), and the pages of the source are
+    # dropped once they're no longer needed.
+    if methods is None:
+        methods = _get_copy_methods(source_fd, destination_fd)
+    view = None
+    end = offset + length
+    while offset < end:
+        size = min(COPY_BUFFER_SIZE, end - offset)
+        try:
+            if methods[0] == 'copy_file_range':
+                count = os.copy_file_range(source_fd, destination_fd, size, offset)
+            elif methods[0] == 'splice':
+                count = os.splice(source_fd, destination_fd, size, offset_src=offset)
+            elif methods[0] == 'sendfile':
+                count = os.sendfile(destination_fd, source_fd, offset, size)
+            else:
+                if view is None:
+                    view = memoryview(bytearray(COPY_BUFFER_SIZE))
+                count = os.preadv(source_fd, [view[:size]], offset)
+                written = 0
+                while written < count:
+                    written += os.write(destination_fd, view[written:count])
+        except OSError as error:
+            if len(methods) > 1 and error.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                methods.pop(0)
+                continue
+            raise
+        if count == 0:
+            if len(methods) > 1:
+                # Some filesystems don't support copying in the kernel,
+                # and just report nothing copied.
+                methods.pop(0)
+                continue
+            break
+
+        writeback.drop_cache(source_fd, offset, count)
+        offset += count
+        position += count
+        if destination_writeback is not None:
+            destination_writeback.written(position)
+    return position
+
+
+def _copy_file(source, destination):
+    # Copies a file without filling the page cache (see _copy_data()).
+    # Returns the number of bytes copied.
+    with open(source, mode='rb', buffering=0) as source_file, \
+            open(destination, mode='wb', buffering=0) as destination_file:
+        destination_writeback = writeback.Writeback(destination_file.fileno())
+        size = os.fstat(source_file.fileno()).st_size
+        count = _copy_data(source_file.fileno(), 0, size, destination_file.fileno(), destination_writeback, 0)
+
+        # The rest is written while the next files are copied.
+        writeback.start_writeback(destination_file.fileno(), destination_writeback.started, 0)
+    _copy_metadata(os.stat(source), destination)
+    return count
+
+
+def _order_by_size(tasks):
+    # Returns the copy tasks with the largest files first, so the longest
+    # copies don't end up running alone at the end, and with the smallest
+    # files in between them, so the device always has some writes to do while
+    # the large files are read.
+    tasks = collections.deque(sorted(tasks, key=lambda task: task[1], reverse=True))
+    ordered = []
+    while tasks:
+        ordered.append(tasks.popleft())
+        if tasks:
+            ordered.append(tasks.pop())
+    return ordered
+
+
+def _run_copies(tasks, threads, result, progress):
+    # Runs the copy tasks, (path, size, function) tuples where function copies
+    # the file and returns the number of bytes copied, in order, with up to
+    # threads of them at the same time.
+    total = sum(size for path, size, function in tasks)
+    lock = threading.Lock()
+
+    def run(task):
+        path, size, function = task
+        count = function()
+        with lock:
+            result.files[path] = count
+            result.total += count
+            if progress is not None:
+                progress(result.total, total)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(run, task) for task in tasks]:
+            future.result()
+
+
+def _drain_pipe(pipe_fd, destination):
+    # Writes what comes out of the pipe, until it's closed, to destination,
+    # and returns the number of bytes written. The data is moved by the
+    # kernel with os.splice(), unless the destination's filesystem doesn't
+    # support it.
+    position = 0
+    use_splice = hasattr(os, 'splice')
+    with open(destination, mode='wb', buffering=0) as destination_file:
+        destination_fd = destination_file.fileno()
+        destination_writeback = writeback.Writeback(destination_fd)
+        while True:
+            if use_splice:
+                try:
+                    count = os.splice(pipe_fd, destination_fd, COPY_BUFFER_SIZE)
+                except OSError as error:
+                    if error.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        use_splice = False
+                        continue
+                    raise
+            else:
+                data = os.read(pipe_fd, COPY_BUFFER_SIZE)
+                count = len(data)
+                written = 0
+                while written < count:
+                    written += os.write(destination_fd, data[written:])
+            if count == 0:
+                break
+            position += count
+            destination_writeback.written(position)
+
+        # The rest is written while the next files are copied.
+        writeback.start_writeback(destination_fd, destination_writeback.started, 0)
+    return position
+
+
+def _set_pipe_size(pipe_fd):
+    # Lets the pipe hold a whole COPY_BUFFER_SIZE block, if the kernel allows
+    # it (see /proc/sys/fs/pipe-max-size).
+    try:
+        fcntl.fcntl(pipe_fd, F_SETPIPE_SZ, COPY_BUFFER_SIZE)
+    except OSError:
+        pass
+
+
+def _extract_files(image, files, result, progress):
+    # Copies the files, (path, entry, destination) tuples, from the IsoImage.
+    # The image is read by this thread only, in the given order, and the
+    # files are written by up to COPY_THREADS threads, one file each, so
+    # the reads don't jump around while the writes of several files are in
+    # flight. Each file goes through a pipe, filled with _copy_data() and
+    # emptied with _drain_pipe(), so the data is moved by the kernel and
+    # never copied into Python. At most COPY_THREADS * 2 pipes are open at
+    # once.
+    total = sum(entry.size for path, entry, destination in files)
+    lock = threading.Lock()
+    failed = threading.Event()
+    pipes = threading.BoundedSemaphore(COPY_THREADS * 2)
+    methods = None
+
+    def write(path, destination, pipe_fd):
+        try:
+            count = _drain_pipe(pipe_fd, destination)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            # The reader gets EPIPE if it's still filling the pipe.
+            os.close(pipe_fd)
+            pipes.release()
+        with lock:
+            result.files[path] = count
+            result.total += count
+            if progress is not None:
+                progress(result.total, total)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=COPY_THREADS) as executor:
+        futures = []
+        for path, entry, destination in files:
+            if failed.is_set():
+                # The error is raised below.
+                break
+            pipes.acquire()
+            read_fd, write_fd = os.pipe()
+            try:
+                _set_pipe_size(write_fd)
+                futures.append(executor.submit(write, path, destination, read_fd))
+            except BaseException:
+                os.close(read_fd)
+                os.close(write_fd)
+                pipes.release()
+                raise
+            try:
+                if methods is None:
+                    methods = _get_copy_methods(image.fd, write_fd)
+                position = 0
+                for offset, length in entry.extents:
+                    end = position + length
+                    position = _copy_data(image.fd, offset, length, write_fd, None, position, methods)
+                    if position != end:
+                        raise IsoError('The image ends before byte ' + str(offset + length) + '.')
+            except BrokenPipeError:
+                # The writer failed, and its error is raised below.
+                if not failed.is_set():
+                    raise
+            finally:
+                os.close(write_fd)
+        for future in futures:
+            future.result()
+
+
+def _scan_directory(source):
+    # Returns an IsoEntry for every file, directory and symlink in the
+    # directory, each directory before its contents. Each directory is read
+    # once with os.scandir(), and only the entries themselves are stat'ed.
+    entries = []
+    directories = collections.deque([source])
+    while directories:
+        directory = directories.popleft()
+        with os.scandir(directory) as directory_entries:
+            for directory_entry in sorted(directory_entries, key=lambda directory_entry: directory_entry.name):
+                file_stat = directory_entry.stat(follow_symlinks=False)
+                path = os.path.relpath(directory_entry.path, source)
+                if stat.S_ISLNK(file_stat.st_mode):
+                    entries.append(IsoEntry(path, 'symlink', mode=file_stat.st_mode,
+                                            target=os.readlink(directory_entry.path), source=directory_entry.path))
+                elif stat.S_ISDIR(file_stat.st_mode):
+                    entries.append(IsoEntry(path, 'directory', mode=file_stat.st_mode, source=directory_entry.path))
+                    directories.append(directory_entry.path)
+                elif stat.S_ISREG(file_stat.st_mode):
+                    entries.append(IsoEntry(path, 'file', file_stat.st_size, mode=file_stat.st_mode,
+                                            source=directory_entry.path))
+    return entries
+
+
+def get_manifest(iso):
+    # Returns the Manifest of the files in the iso file (read with IsoImage,
+    # which can also be given already open) or in the directory it's mounted
+    # on.
+    if isinstance(iso, IsoImage):
+        # The entries are kept by the image, so get_entry() doesn't walk it
+        # again.
+        if iso._entries is None:
+            iso._entries = {entry.path: entry for entry in iso.walk()}
+        return Manifest(iso.path, list(iso._entries.values()))
+    if os.path.isdir(iso):
+        return Manifest(iso, _scan_directory(iso))
+    with IsoImage(iso) as image:
+        return Manifest(iso, list(image.walk()))
+
+
+def _copy_tree(manifest, device_mountpoint, progress):
+    # Copies the contents of a directory (the mount point of the iso file).
+    # Symlinks are copied as symlinks if the usb's filesystem supports them.
+    # Otherwise, symlinks to files in the directory are replaced by copies of
+    # the files, and the rest are skipped, which also avoids symlink loops.
+    result = CopyResult()
+    symlinks = _can_symlink(device_mountpoint)
+    real_source = os.path.realpath(manifest.source)
+    tasks = []
+    directories = []
+    for entry in manifest.entries:
+        destination = os.path.join(device_mountpoint, entry.path)
+        if entry.kind == 'symlink':
+            target = os.path.realpath(entry.source)
+            if symlinks:
+                os.symlink(entry.target, destination)
+            elif os.path.isfile(target) and target.startswith(real_source + os.sep):
+                tasks.append((entry.path, os.path.getsize(target), functools.partial(_copy_file, target, destination)))
+        elif entry.kind == 'directory':
+            os.makedirs(destination, exist_ok=True)
+            directories.append((entry.source, destination))
+        else:
+            tasks.append((entry.path, entry.size, functools.partial(_copy_file, entry.source, destination)))
+
+    _run_copies(_order_by_size(tasks), COPY_THREADS, result, progress)
+    # Directories are made read-only last, so their contents can be created
+    # first.
+    for source, destination in reversed(directories):
+        _copy_metadata(os.stat(source), destination)
+    return result
+
+
+def _get_seek_distance(files):
+    # Returns the number of bytes the reads of the files (IsoEntry objects)
+    # jump over, in total, if they are read in the given order. Empty extents
+    # (of empty files, which are usually at LBA 0) aren't read, so they're
+    # skipped.
+    distance = 0
+    position = None
+    for entry in files:
+        for offset, length in entry.extents:
+            if length == 0:
+                continue
+            if position is not None:
+                distance += abs(offset - position)
+            position = offset + length
+    return distance
+
+
+def _extract_iso_contents(iso, manifest, device_mountpoint, progress):
+    # Copies the contents of the iso file with IsoImage, without mounting it.
+    # Directories and symlinks are created first, and then the files are
+    # copied in the order they are stored in the image, so it's read from
+    # start to end instead of jumping around as in directory order. Symlinks
+    # are handled like in _copy_tree().
+    result = CopyResult()
+    symlinks = _can_symlink(device_mountpoint)
+    with IsoImage(iso) as image:
+        entries = manifest.entries
+        files = manifest.get_files()
+        result.unsorted_seek_distance = _get_seek_distance(files)
+        # Empty files have nothing to read, so they're left out of the sort
+        # and created last.
+        files = sorted((entry for entry in files if entry.size), key=lambda entry: entry.extents[0][0]) + \
+            [entry for entry in files if not entry.size]
+        result.seek_distance = _get_seek_distance(files)
+
+        copies = []
+        for entry in entries:
+            path = os.path.join(device_mountpoint, entry.path)
+            if entry.kind == 'directory':
+                os.makedirs(path, exist_ok=True)
+            elif entry.kind == 'symlink':
+                if symlinks:
+                    os.symlink(entry.target, path)
+                else:
+                    target = image.resolve(entry)
+                    if target is not None and target.kind == 'file':
+                        copies.append((entry.path, target, path))
+        copies = [(entry.path, entry, os.path.join(device_mountpoint, entry.path)) for entry in files] + copies
+
+        _extract_files(image, copies, result, progress)
+
+        for entry in reversed(entries):
+            if entry.mode is not None and entry.kind != 'symlink':
+                try:
+                    os.chmod(os.path.join(device_mountpoint, entry.path), entry.mode & 0o7777)
+                except OSError:
+                    # FAT32, for example.
+                    pass
+    return result
+
+
+def copy_iso_contents(iso_mountpoint, device_mountpoint, progress=None, manifest=None):
+    # iso_mountpoint is the mount point of the iso file, or the iso file
+    # itself, which is then read directly (see IsoImage).
+    # The files are listed first (unless their manifest, from get_manifest(),
+    # is given, which can be made from another copy of the image, like the
+    # one staged in memory by dd.get_staged_path()), and CopyError is raised before copying anything if they
+    # don't fit on the usb's filesystem.
+    # progress is called as progress(bytes_copied, bytes_total) after every
+    # file. Returns a CopyResult.
+    if manifest is None:
+        manifest = get_manifest(iso_mountpoint)
+    filesystem_stat = os.statvfs(device_mountpoint)
+    manifest.check(filesystem_stat.f_bavail * filesystem_stat.f_frsize, mount.get_filesystem_type(device_mountpoint))
+
+    if os.path.isdir(iso_mountpoint):
+        result = _copy_tree(manifest, device_mountpoint, progress)
+    else:
+        result = _extract_iso_contents(iso_mountpoint, manifest, device_mountpoint, progress)
+    # Only the usb's filesystem has to be synced.
+    writeback.syncfs(device_mountpoint)
+    return result
 
 
 def create_bootable_usb(device, device_mountpoint, bootloader, target, partition_table, syslinux, syslinux_modules,
@@ -314,3 +767,337 @@ def install_systemd_boot(device_mountpoint):
 
     if os.path.isfile('/usr/lib/systemd/boot/efi/systemd-bootia32.efi'):
         shutil.copy('/usr/lib/systemd/boot/efi/systemd-bootia32.efi', device_mountpoint + '/boot/efi/bootia32.efi')
+
+
+class IsoEntry:
+    def __init__(self, path, kind, size=0, extents=None, mode=None, target=None, source=None):
+        # Path relative to the root of the image.
+        self.path = path
+        # 'file', 'directory' or 'symlink'.
+        self.kind = kind
+        self.size = size
+        # Byte ranges of the image with the contents of the file (or the
+        # records of the directory), as (offset, length) tuples.
+        self.extents = extents or []
+        # Permissions from Rock Ridge, or None.
+        self.mode = mode
+        # Target of the symlink.
+        self.target = target
+        # Path of the file, for images read from their mount point.
+        self.source = source
+
+
+class IsoImage:
+    # Reads the files of an ISO 9660 image directly, so it doesn't have to be
+    # loop mounted. File names are taken from the Rock Ridge extensions if
+    # present (along with permissions and symlinks), or else from the Joliet
+    # ones, or else from the plain ISO 9660 names, lowercased like Linux
+    # shows them. UDF trees are not read, see is_udf().
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self._entries = None
+        try:
+            self._read_volume_descriptors()
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def _read(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        if len(data) != length:
+            raise IsoError('The image ends before byte ' + str(offset + length) + '.')
+        return data
+
+    def _read_volume_descriptors(self):
+        primary = None
+        joliet = None
+        sector = ISO_FIRST_DESCRIPTOR
+        while True:
+            descriptor = self._read(sector * ISO_SECTOR_SIZE, ISO_SECTOR_SIZE)
+            if descriptor[1:6] != b'CD001':
+                raise IsoError('This is not an ISO 9660 image.')
+            if descriptor[0] == 1 and primary is None:
+                primary = descriptor
+            elif descriptor[0] == 2 and descriptor[88:91] in JOLIET_ESCAPE_SEQUENCES and joliet is None:
+                joliet = descriptor
+            elif descriptor[0] == 255:
+                break
+            sector += 1
+        if primary is None:
+            raise IsoError('The image has no primary volume descriptor.')
+
+        self.block_size = struct.unpack_from('<H', primary, 128)[0]
+        if self.block_size not in ISO_BLOCK_SIZES:
+            raise IsoError('The image has an invalid block size of ' + str(self.block_size) + ' bytes.')
+        self.root = self._parse_record(primary, 156)
+
+        # Rock Ridge is present if the root directory's "." record starts
+        # with a SUSP "SP" entry.
+        self.rock_ridge = False
+        self.susp_skip = 0
+        first = self._read_first_record(self.root['extent'], self.root['size'])
+        system_use = first['system_use']
+        if system_use[:2] == b'SP' and system_use[4:6] == b'\xbe\xef':
+            self.rock_ridge = True
+            self.susp_skip = system_use[6]
+        elif joliet is not None:
+            self.joliet = True
+            self.root = self._parse_record(joliet, 156)
+            return
+        self.joliet = False
+
+    def _parse_record(self, data, offset):
+        # Raises IsoError if the record doesn't fit in data, or its name
+        # doesn't fit in the record.
+        if offset + ISO_RECORD_HEADER_SIZE >= len(data):
+            raise IsoError('A directory record of the image is cut off.')
+        length = data[offset]
+        name_length = data[offset + 32]
+        if length < ISO_RECORD_HEADER_SIZE + name_length or offset + length > len(data):
+            raise IsoError('The image has a directory record with an invalid length.')
+        name = data[offset + 33:offset + 33 + name_length]
+        # A padding byte follows even length names.
+        system_use_start = offset + 33 + name_length + (1 - name_length % 2)
+        return {'extent': struct.unpack_from('<I', data, offset + 2)[0] + data[offset + 1],
+                'size': struct.unpack_from('<I', data, offset + 10)[0],
+                'flags': data[offset + 25],
+                'name': name,
+                'system_use': data[system_use_start:offset + length]}
+
+    def _read_records(self, extent, size):
+        # Returns the records of a directory. Records never cross sector
+        # boundaries, and the rest of a sector is filled with zeros.
+        data = self._read(extent * self.block_size, size)
+        records = []
+        offset = 0
+        while offset < size:
+            if data[offset] == 0:
+                offset = (offset // ISO_SECTOR_SIZE + 1) * ISO_SECTOR_SIZE
+                continue
+            if offset % ISO_SECTOR_SIZE + data[offset] > ISO_SECTOR_SIZE:
+                raise IsoError('The image has a directory record that crosses a sector boundary.')
+            records.append(self._parse_record(data, offset))
+            offset += data[offset]
+        return records
+
+    def _read_first_record(self, extent, size):
+        # Returns the "." record of a directory.
+        records = self._read_records(extent, size)
+        if not records:
+            raise IsoError('The image has an empty directory at block ' + str(extent) + '.')
+        return records[0]
+
+    def _read_susp(self, system_use):
+        # Returns the SUSP entries of a record, as (signature, data) tuples,
+        # following continuation areas.
+        entries = []
+        areas = [system_use[self.susp_skip:]]
+        while areas:
+            area = areas.pop(0)
+            offset = 0
+            while offset + 4 <= len(area):
+                signature = area[offset:offset + 2]
+                length = area[offset + 2]
+                if length < 4 or signature == b'ST':
+                    break
+                if offset + length > len(area) or length < SUSP_MIN_LENGTHS.get(signature, 4):
+                    raise IsoError('The image has a system use entry with an invalid length.')
+                data = area[offset:offset + length]
+                if signature == b'CE':
+                    block, area_offset, area_length = struct.unpack_from('<I4xI4xI', data, 4)
+                    areas.append(self._read(block * self.block_size + area_offset, area_length))
+                else:
+                    entries.append((signature, data))
+                offset += length
+        return entries
+
+    def _get_name(self, record):
+        # Returns the name of the record, and the Rock Ridge information
+        # (mode, symlink target, relocation) if present.
+        info = {'mode': None, 'target': None, 'child': None, 'relocated': False}
+        name = None
+        if self.rock_ridge:
+            name_parts = []
+            target_parts = []
+            component = b''
+            for signature, data in self._read_susp(record['system_use']):
+                if signature == b'NM' and not data[4] & 0x06:
+                    name_parts.append(data[5:])
+                elif signature == b'PX':
+                    info['mode'] = struct.unpack_from('<I', data, 4)[0]
+                elif signature == b'SL':
+                    offset = 5
+                    while offset + 2 <= len(data):
+                        flags, length = data[offset], data[offset + 1]
+                        content = data[offset + 2:offset + 2 + length]
+                        if flags & 0x02:
+                            component = b'.'
+                        elif flags & 0x04:
+                            component = b'..'
+                        elif flags & 0x08:
+                            component = b''
+                            target_parts.append(b'')
+                        else:
+                            component += content
+                        if not flags & 0x01 and not flags & 0x08:
+                            target_parts.append(component)
+                            component = b''
+                        offset += 2 + length
+                elif signature == b'CL':
+                    info['child'] = struct.unpack_from('<I', data, 4)[0]
+                elif signature == b'RE':
+                    info['relocated'] = True
+            if name_parts:
+                name = b''.join(name_parts).decode('utf_8', 'replace')
+            if target_parts:
+                if target_parts == [b'']:
+                    info['target'] = '/'
+                else:
+                    info['target'] = b'/'.join(target_parts).decode('utf_8', 'replace')
+
+        if name is None:
+            if self.joliet:
+                name = record['name'].decode('utf_16_be', 'replace')
+            else:
+                name = record['name'].decode('ascii', 'replace').lower()
+            # The version number and the dot of names without an extension
+            # are dropped.
+            name = name.split(';')[0]
+            if name.endswith('.') and not self.joliet:
+                name = name[:-1]
+        return name, info
+
+    def walk(self):
+        # Yields an IsoEntry for every file, directory and symlink in the
+        # image, each directory before its contents.
+        # IsoError is raised if a directory appears twice, so corrupt images
+        # with loops don't make this run forever.
+        directories = collections.deque([('', self.root['extent'], self.root['size'])])
+        visited = {self.root['extent']}
+
+        def add_directory(path, extent, size):
+            if extent in visited:
+                raise IsoError('The directory ' + path + ' of the image loops back to block ' + str(extent) + '.')
+            visited.add(extent)
+            directories.append((path, extent, size))
+
+        while directories:
+            directory, extent, size = directories.popleft()
+            records = self._read_records(extent, size)
+            # Files bigger than 4 GiB are split in several records, and all
+            # but the last one have the multi-extent flag.
+            extents = []
+            for record in records:
+                if record['name'] in (b'\x00', b'\x01') or record['flags'] & ISO_ASSOCIATED_FLAG:
+                    continue
+                extents.append((record['extent'] * self.block_size, record['size']))
+                if record['flags'] & ISO_MULTI_EXTENT_FLAG:
+                    continue
+                file_extents, extents = extents, []
+
+                name, info = self._get_name(record)
+                if info['relocated']:
+                    # Shown where its "CL" entry is.
+                    continue
+                path = directory + '/' + name if directory else name
+                if info['child'] is not None:
+                    child = self._read_first_record(info['child'], self.block_size)
+                    add_directory(path, child['extent'], child['size'])
+                    yield IsoEntry(path, 'directory', mode=info['mode'])
+                elif record['flags'] & ISO_DIRECTORY_FLAG:
+                    add_directory(path, record['extent'], record['size'])
+                    yield IsoEntry(path, 'directory', mode=info['mode'])
+                elif info['target'] is not None:
+                    yield IsoEntry(path, 'symlink', mode=info['mode'], target=info['target'])
+                else:
+                    yield IsoEntry(path, 'file', sum(length for offset, length in file_extents), file_extents,
+                                   info['mode'])
+
+    def resolve(self, entry):
+        # Returns the IsoEntry that a symlink points to, or None if it points
+        # outside the image or to nothing.
+        if entry.target.startswith('/'):
+            return None
+        path = os.path.normpath(os.path.join(os.path.dirname(entry.path), entry.target))
+        if path.startswith('..'):
+            return None
+        return self.get_entry(path)
+
+    def get_entry(self, path):
+        # Returns the IsoEntry of path (relative to the root of the image),
+        # or None if there's none.
+        if self._entries is None:
+            self._entries = {entry.path: entry for entry in self.walk()}
+        return self._entries.get(path.strip('/'))
+
+    def exists(self, path):
+        return self.get_entry(path) is not None
+
+    def isfile(self, path):
+        entry = self.get_entry(path)
+        return entry is not None and entry.kind == 'file'
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Manifest:
+    def __init__(self, source, entries):
+        # The iso file or its mount point, and its IsoEntry objects.
+        self.source = source
+        self.entries = entries
+
+    def get_files(self):
+        return [entry for entry in self.entries if entry.kind == 'file']
+
+    def get_total_size(self):
+        return sum(entry.size for entry in self.get_files())
+
+    def check(self, free_space, filesystem=None):
+        # Raises CopyError if the files don't fit in free_space bytes, or if
+        # one of them is too big for the filesystem (its type as in
+        # /proc/mounts, or its name as in the gui).
+        if filesystem is not None and filesystem.lower() in FAT_FILESYSTEMS:
+            for entry in self.get_files():
+                if entry.size > FAT_MAX_FILE_SIZE:
+                    raise CopyError(entry.path + ' is bigger than 4 GiB, which FAT32 does not support.')
+        if self.get_total_size() > free_space:
+            raise CopyError('The files need ' + str(self.get_total_size()) + ' bytes, but only ' + str(free_space) +
+                            ' are available.')
+
+
+class CopyResult:
+    def __init__(self):
+        # Number of bytes copied, in total and for each file (by its path
+        # relative to the root of the image).
+        self.total = 0
+        self.files = {}
+        # Bytes of the image skipped over by the reads, in the order the files
+        # were copied, and in the order of the directories.
+        self.seek_distance = 0
+        self.unsorted_seek_distance = 0
+
+    def get_saved_seek_distance(self):
+        return self.unsorted_seek_distance - self.seek_distance
+
+    def __str__(self):
+        text = 'Copied ' + str(self.total) + ' bytes in ' + str(len(self.files)) + ' files'
+        if self.unsorted_seek_distance == 0:
+            return text + '.'
+        return text + ', seeking over ' + str(self.seek_distance) + ' bytes (' + \
+            str(self.get_saved_seek_distance()) + ' less than in directory order).'
+
+
+class IsoError(Exception):
+    pass
+
+
+class CopyError(Exception):
+    pass
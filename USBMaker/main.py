@@ -36,8 +36,9 @@ import iso
 class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     # Signals have to be declared here.
     signal_format = QtCore.pyqtSignal(str, str, str, str, int, int, str)
-    signal_dd = QtCore.pyqtSignal(str, str, int, str)
-    signal_iso = QtCore.pyqtSignal(str, str, str, str, str, list, str, int, int, str, list, list, str)
+    signal_dd = QtCore.pyqtSignal(str, str, int, str, str, str)
+    signal_dd_multi = QtCore.pyqtSignal(list, str, str)
+    signal_iso = QtCore.pyqtSignal(str, str, str, str, str, list, str, int, int, str, list, list, str, object)
 
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -75,6 +76,10 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.comboBox_checkbadblocks.insertItem(2, '3 Passes')
         self.comboBox_checkbadblocks.insertItem(3, '4 Passes')
 
+        # The hash algorithms are stored as item data, shown by their names.
+        for algorithm in dd.get_hash_algorithms():
+            self.comboBox_verify.addItem(dd.HASH_ALGORITHMS[algorithm], algorithm)
+
         # Check for dependencies and their locations
         self.dependencies = {}
         self.update_dependencies()
@@ -123,6 +128,14 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.comboBox_clustersize.currentIndexChanged.connect(self.update_gui)
         self.checkBox_bootmethod.stateChanged.connect(self.update_gui)
         self.checkBox_checkbadblocks.stateChanged.connect(self.update_gui)
+        self.checkBox_verify.stateChanged.connect(self.update_gui)
+        self.comboBox_device.currentIndexChanged.connect(self.update_gui)
+
+        # Images can only be kept in memory if memfds are supported.
+        self.checkBox_staging.stateChanged.connect(self.set_staging)
+        if not hasattr(os, 'memfd_create'):
+            self.checkBox_staging.setEnabled(False)
+            self.checkBox_staging.setToolTip('This needs Python 3.8 or newer.')
 
         # update_gui is called to finish the initialization of the gui.
         self.update_gui()
@@ -141,6 +154,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         # corresponding functions from the worker object.
         self.signal_format.connect(self.worker.format)
         self.signal_dd.connect(self.worker.make_bootable_dd)
+        self.signal_dd_multi.connect(self.worker.make_bootable_dd_multi)
         self.signal_iso.connect(self.worker.make_bootable_iso)
 
         # The start button is connected to the start function.
@@ -154,6 +168,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         # - grub4dos (bootlace(64).com)
         # - systemd-boot
         # - dd
+        # - zstd
         # - mkfs.fat
         # - mkfs.exfat
         # - mkfs.ntfs
@@ -202,6 +217,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         else:
             self.dependencies['dd'] = True
 
+        # zstd (.zst images can't be decompressed without it, unlike .xz ones)
+        if shutil.which('zstd') is None:
+            self.dependencies['zstd'] = False
+        else:
+            self.dependencies['zstd'] = True
+
         # mkfs.fat
         if shutil.which('mkfs.fat') is None:
             self.dependencies['mkfs.fat'] = False
@@ -359,6 +380,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.comboBox_clustersize.currentIndexChanged.disconnect()
         self.checkBox_bootmethod.stateChanged.disconnect()
         self.checkBox_checkbadblocks.stateChanged.disconnect()
+        self.checkBox_verify.stateChanged.disconnect()
 
         if self.comboBox_bootmethod.currentText() == "DD Image" and self.checkBox_bootmethod.isChecked():
             # Most of the gui is disabled if "DD Image" is selected.
@@ -426,6 +448,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.checkBox_checkbadblocks.setChecked(False)
             self.comboBox_checkbadblocks.setEnabled(False)
 
+        # Bad blocks are only checked when writing to a single device.
+        if self.all_devices_selected():
+            self.checkBox_checkbadblocks.setEnabled(False)
+            self.checkBox_checkbadblocks.setChecked(False)
+            self.comboBox_checkbadblocks.setEnabled(False)
+
         if not self.checkBox_bootmethod.isChecked():
             self.comboBox_bootmethod.setEnabled(False)
             self.pushButton_filedialog.setEnabled(False)
@@ -438,6 +466,18 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         else:
             self.comboBox_checkbadblocks.setEnabled(True)
 
+        # Only images written in DD mode can be verified.
+        if self.comboBox_bootmethod.currentText() == "DD Image" and self.checkBox_bootmethod.isChecked():
+            self.checkBox_verify.setEnabled(True)
+        else:
+            self.checkBox_verify.setEnabled(False)
+            self.checkBox_verify.setChecked(False)
+
+        if not self.checkBox_verify.isChecked():
+            self.comboBox_verify.setEnabled(False)
+        else:
+            self.comboBox_verify.setEnabled(True)
+
         # Here the trigger for update_ui is re-enabled.
         self.comboBox_filesystem.currentIndexChanged.connect(self.update_gui)
         self.comboBox_partscheme.currentIndexChanged.connect(self.update_gui)
@@ -445,6 +485,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.comboBox_clustersize.currentIndexChanged.connect(self.update_gui)
         self.checkBox_bootmethod.stateChanged.connect(self.update_gui)
         self.checkBox_checkbadblocks.stateChanged.connect(self.update_gui)
+        self.checkBox_verify.stateChanged.connect(self.update_gui)
 
     def disable_gui(self):
         self.pushButton_start.setEnabled(False)
@@ -460,6 +501,9 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.lineEdit_label.setEnabled(False)
         self.checkBox_checkbadblocks.setEnabled(False)
         self.checkBox_bootmethod.setEnabled(False)
+        self.checkBox_verify.setEnabled(False)
+        self.comboBox_verify.setEnabled(False)
+        self.checkBox_staging.setEnabled(False)
 
     def enable_gui(self):
         self.pushButton_start.setEnabled(True)
@@ -475,9 +519,19 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.lineEdit_label.setEnabled(True)
         self.checkBox_checkbadblocks.setEnabled(True)
         self.checkBox_bootmethod.setEnabled(True)
+        self.checkBox_staging.setEnabled(hasattr(os, 'memfd_create'))
 
         self.update_gui()
 
+    def set_staging(self):
+        # The images are kept in memory between writes (see
+        # dd.enable_staging()), so writing the same image to many devices, one
+        # after another, doesn't read it from the disk every time.
+        if self.checkBox_staging.isChecked():
+            dd.enable_staging()
+        else:
+            dd.disable_staging()
+
     @QtCore.pyqtSlot(bool)
     def set_enabled(self, enable):
         if enable:
@@ -538,12 +592,18 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.comboBox_device.addItem('(' + str(round(usb_info.get_size(
                 usb_info.get_block_device_name(device))/1073741824, 1)) + 'GiB) ' + device)
 
+        # DD images can be written to all the devices at once.
+        if len(self.device_id_list) > 1:
+            self.comboBox_device.addItem('All ' + str(len(self.device_id_list)) + ' devices (DD Image only)')
+
     def get_file_name(self):
         # getOpenFileName returns a tuple with the file path and the filter,
         # so to get only the file path we use [0].
         # If the user selects the cancel button, self.filename remains unchanged
         filename = QtWidgets.QFileDialog.getOpenFileName(directory=self.homedir,
-                                                         filter='ISO Files (*.iso);;All Files (*)',
+                                                         filter='ISO Files (*.iso);;' +
+                                                         'Disk Images (*.img *.img.xz *.img.gz *.img.bz2 *.img.zst);;' +
+                                                         'All Files (*)',
                                                          initialFilter='ISO Files (*.iso)')[0]
         if filename != '':
             # Only change self.filename if a file is actually selected.
@@ -585,6 +645,13 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         else:
             return 1
 
+    def get_verify_algorithm(self):
+        # An empty algorithm means the image is not verified.
+        if self.checkBox_verify.isChecked():
+            return self.comboBox_verify.currentData()
+        else:
+            return ''
+
     def get_cluster_size(self):
         if self.comboBox_clustersize.currentText() == '512':
             return 512
@@ -611,6 +678,10 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def get_device_id(self):
         return self.device_id_list[self.comboBox_device.currentIndex()]
 
+    def all_devices_selected(self):
+        # The "All devices" item is the one after the last device.
+        return self.comboBox_device.currentIndex() == len(self.device_id_list)
+
     def get_filesystem(self):
         return self.comboBox_filesystem.currentText().lower()
 
@@ -688,16 +759,31 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         device = usb_info.get_block_device_name(device_id)
         badblocks_passes = self.get_badblocks_passes()
         badblocks_file = '/tmp/usbmaker' + str(os.getpid()) + '-badblocks.txt'
+        verify_algorithm = self.get_verify_algorithm()
 
         if not self.dependencies['badblocks']:
             badblocks_passes = 0
 
-        if not self.dependencies['dd']:
+        # The image is written by dd.dd() itself, so the dd executable is not required.
+        if dd.get_compression(self.filename) == 'zstd' and not self.dependencies['zstd']:
             QtWidgets.QMessageBox.warning(self, 'USBMaker', 'Could not find the software required to perform this ' +
-                                          'action. The dependencies that need to be installed are:\n' + '\ndd')
+                                          'action. The dependencies that need to be installed are:\n\nzstd')
         else:
             # Send a signal to the worker object to start the make_bootable_dd() function.
-            self.signal_dd.emit(device, self.filename, badblocks_passes, badblocks_file)
+            self.signal_dd.emit(device, self.filename, badblocks_passes, badblocks_file, device_id,
+                                verify_algorithm)
+
+    def start_dd_multi(self):
+        devices = []
+        for device_id in self.device_id_list:
+            devices.append(usb_info.get_block_device_name(device_id))
+
+        if dd.get_compression(self.filename) == 'zstd' and not self.dependencies['zstd']:
+            QtWidgets.QMessageBox.warning(self, 'USBMaker', 'Could not find the software required to perform this ' +
+                                          'action. The dependencies that need to be installed are:\n\nzstd')
+        else:
+            # Send a signal to the worker object to start the make_bootable_dd_multi() function.
+            self.signal_dd_multi.emit(devices, self.filename, self.get_verify_algorithm())
 
     def start_iso(self):
         # Collect information.
@@ -711,19 +797,40 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         clustersize = self.get_cluster_size()
         target = self.get_target()
 
+        # The iso file is read directly, so it doesn't have to be mounted,
+        # unless it's a UDF image (see iso.is_udf()).
         iso_mountpoint = '/tmp/usbmaker' + str(os.getpid()) + '-iso'
-        mount.mount_iso(self.filename, iso_mountpoint)
-
-        bootloader = [iso.get_uefi_bootloader_name(iso_mountpoint), iso.get_bios_bootloader_name(iso_mountpoint)]
+        try:
+            if iso.is_udf(self.filename):
+                mount.mount_iso(self.filename, iso_mountpoint)
+                iso_image = iso_mountpoint
+            else:
+                iso_image = iso.IsoImage(self.filename)
+            try:
+                # The image is only walked once: the manifest is also used to
+                # look for the bootloaders, and then to copy the files.
+                manifest = iso.get_manifest(iso_image)
 
-        # Check if a UEFI bootloader is present.
-        if os.path.isfile(iso_mountpoint + '/boot/efi/bootx64.efi') or \
-           os.path.isfile(iso_mountpoint + '/boot/efi/bootia32.efi'):
-            uefi_bootloader_installed = True
-        else:
-            uefi_bootloader_installed = False
+                bootloader = [iso.get_uefi_bootloader_name(iso_image), iso.get_bios_bootloader_name(iso_image)]
 
-        mount.unmount(iso_mountpoint)
+                # Check if a UEFI bootloader is present.
+                uefi_bootloader_installed = iso.has_uefi_bootloader(iso_image)
+            finally:
+                if isinstance(iso_image, iso.IsoImage):
+                    iso_image.close()
+                else:
+                    mount.unmount(iso_mountpoint)
+        except (iso.IsoError, OSError) as error:
+            self.label_status.setText('Error: ' + str(error))
+            return
+
+        # Check that the files fit on the usb before formatting it. The
+        # filesystem's overhead isn't known yet, so the copy checks again.
+        try:
+            manifest.check(usb_info.get_size(device), filesystem)
+        except iso.CopyError as error:
+            self.label_status.setText('Error: ' + str(error))
+            return
 
         # Ask user whether to replace the bootloader or use the included one.
         if uefi_bootloader_installed:
@@ -876,18 +983,25 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             # Send a signal to the worker object to start the make_bootable_iso() function.
             self.signal_iso.emit(device, self.filename, filesystem, partition_table, target, bootloader, label,
                                  clustersize, badblocks_passes, badblocks_file, self.syslinux, self.syslinux_modules,
-                                 self.grldr)
+                                 self.grldr, manifest)
 
     def start(self):
         # Check if there's a device selected.
         if self.comboBox_device.currentText() != '':
-            if self.checkBox_bootmethod.isChecked():
+            if self.all_devices_selected() and (not self.checkBox_bootmethod.isChecked() or
+                                                self.comboBox_bootmethod.currentText() != 'DD Image'):
+                # Only DD images can be written to several devices.
+                self.label_status.setText('Error: select a single device.')
+            elif self.checkBox_bootmethod.isChecked():
                 # Check if there's a file selected.
                 if self.filename != '':
                     if self.comboBox_bootmethod.currentText() == 'DD Image':
                         # Calling QThread.start() after the QThread is already started does nothing.
                         self.thread.start()
-                        self.start_dd()
+                        if self.all_devices_selected():
+                            self.start_dd_multi()
+                        else:
+                            self.start_dd()
                     elif self.comboBox_bootmethod.currentText() == 'ISO Image':
                         # Calling QThread.start() after the QThread is already started does nothing.
                         self.thread.start()
@@ -919,6 +1033,8 @@ class WorkerObject(QtCore.QObject):
         self.signal_set_status.connect(self.main_window.set_status)
         self.signal_show_badblocks_messagebox.connect(self.main_window.show_badblocks_messagebox)
 
+        self.dd_percentage = 0
+
     @QtCore.pyqtSlot(str, str, str, str, int, int, str)
     def format(self, device, filesystem, partition_table, label, clustersize, badblocks_passes, badblocks_file):
         # Requires: parted, mkfs.*
@@ -965,11 +1081,11 @@ class WorkerObject(QtCore.QObject):
 
         self.signal_set_enabled.emit(True)
 
-    @QtCore.pyqtSlot(str, str, int, str)
-    def make_bootable_dd(self, device, filename, badblocks_passes, badblocks_file):
-        # Requires: dd
+    @QtCore.pyqtSlot(str, str, int, str, str, str)
+    def make_bootable_dd(self, device, filename, badblocks_passes, badblocks_file, device_id, verify_algorithm):
         self.signal_set_enabled.emit(False)
         self.signal_set_progress.emit(0)
+        self.dd_percentage = 0
 
         # Unmount partitions before continuing.
         mount.unmount_all_partitions(device)
@@ -981,18 +1097,132 @@ class WorkerObject(QtCore.QObject):
             # Show message box informing the user of the badblocks check.
             self.signal_show_badblocks_messagebox.emit(badblocks_file)
 
-        # Write image to usb
-        self.signal_set_status.emit('Writing image...')
-        dd.dd(filename, device)
+        # The image is written by dd.dd() itself, which raises instead of
+        # returning an error code.
+        try:
+            # If there's a bmap file next to the image, only the mapped blocks are written.
+            bmap = dd.find_bmap(filename)
+            if bmap is not None:
+                bmap = dd.read_bmap(bmap)
+
+            # The block size and queue depth are measured once for each device model,
+            # unless an interrupted write is resumed.
+            self.signal_set_status.emit('Measuring write speed...')
+            block_size, queue_depth = dd.tune_writes(filename, device, device_id, progress=self.dd_progress,
+                                                     journal_id=device_id, bmap=bmap)
+
+            # Write image to usb
+            self.signal_set_status.emit('Writing image...')
+            self.signal_set_progress.emit(0)
+            self.dd_percentage = 0
+            # The write is journaled under the device's id, so an interrupted write to
+            # the same device is resumed.
+            # When verifying, the image is hashed while it's written (unless its
+            # digest is already cached), so only the device has to be read afterwards.
+            hash_object = None
+            if verify_algorithm and dd.get_cached_digest(filename, verify_algorithm, bmap) is None:
+                hash_object = dd.new_hash(verify_algorithm)
+            written = dd.dd(filename, device, block_size=block_size, progress=self.dd_progress,
+                            queue_depth=queue_depth, zero_policy='skip', hash_object=hash_object, bmap=bmap,
+                            journal_id=device_id)
+
+            self.signal_set_progress.emit(100)
+
+            if verify_algorithm:
+                self.signal_set_status.emit('Verifying...')
+                self.signal_set_progress.emit(0)
+                self.dd_percentage = 0
+                iso_digest = None
+                if hash_object is not None:
+                    iso_digest = hash_object.digest()
+                if dd.dd_check(filename, device, progress=self.dd_progress, iso_digest=iso_digest, size=written,
+                               algorithm=verify_algorithm, bmap=bmap):
+                    self.signal_set_progress.emit(100)
+                    self.signal_set_status.emit('Completed.')
+                else:
+                    self.signal_set_status.emit('Error: the written image doesn\'t match the original.')
+            else:
+                self.signal_set_status.emit('Completed.')
+        except (dd.WriteError, dd.ChecksumError, dd.VerifyError, EOFError, OSError) as error:
+            self.signal_set_status.emit('Error: ' + str(error))
+
+        self.signal_set_enabled.emit(True)
+
+    @QtCore.pyqtSlot(list, str, str)
+    def make_bootable_dd_multi(self, devices, filename, verify_algorithm):
+        self.signal_set_enabled.emit(False)
+        self.signal_set_progress.emit(0)
+        self.dd_percentage = 0
+
+        # Unmount partitions before continuing.
+        for device in devices:
+            mount.unmount_all_partitions(device)
+
+        # Write image to all the usb drives, reading it only once. Errors of
+        # a single device are reported in its result, the rest are raised.
+        # When verifying, the image is hashed while it's written (unless its
+        # digest is already cached), so only the devices have to be read afterwards.
+        self.signal_set_status.emit('Writing image to ' + str(len(devices)) + ' devices...')
+        try:
+            bmap = dd.find_bmap(filename)
+            if bmap is not None:
+                bmap = dd.read_bmap(bmap)
+            hash_object = None
+            if verify_algorithm and dd.get_cached_digest(filename, verify_algorithm, bmap) is None:
+                hash_object = dd.new_hash(verify_algorithm)
+            results = dd.dd_multi(filename, devices, progress=self.dd_progress, zero_policy='skip',
+                                  hash_object=hash_object, bmap=bmap)
+
+            failed = []
+            for device in devices:
+                if not results[device].is_ok():
+                    failed.append(str(results[device]))
+                elif verify_algorithm:
+                    self.signal_set_status.emit('Verifying ' + device + '...')
+                    self.signal_set_progress.emit(0)
+                    self.dd_percentage = 0
+                    iso_digest = None
+                    if hash_object is not None:
+                        iso_digest = hash_object.digest()
+                    try:
+                        if not dd.dd_check(filename, device, progress=self.dd_progress, iso_digest=iso_digest,
+                                           size=results[device].written, algorithm=verify_algorithm, bmap=bmap):
+                            failed.append(device + ': the written image doesn\'t match the original.')
+                    except (EOFError, OSError) as error:
+                        failed.append(device + ': ' + str(error))
+        except (dd.ChecksumError, EOFError, OSError) as error:
+            self.signal_set_status.emit('Error: ' + str(error))
+            self.signal_set_enabled.emit(True)
+            return
 
         self.signal_set_progress.emit(100)
-        self.signal_set_status.emit('Completed.')
+        if failed:
+            self.signal_set_status.emit('Completed with errors. ' + ' '.join(failed))
+        else:
+            self.signal_set_status.emit('Completed.')
 
         self.signal_set_enabled.emit(True)
 
-    @QtCore.pyqtSlot(str, str, str, str, str, list, str, int, int, str, list, list, str)
+    def copy_progress(self, copied, total):
+        # The copy goes from 25% to 80% of the progress bar.
+        if total > 0:
+            self.signal_set_progress.emit(25 + int(copied * 55 / total))
+
+    def dd_progress(self, written, total):
+        # Only emit the signal when the percentage changes, as this is called
+        # once per written block.
+        if total > 0:
+            percentage = int(written * 100 / total)
+        else:
+            percentage = 100
+
+        if percentage != self.dd_percentage:
+            self.dd_percentage = percentage
+            self.signal_set_progress.emit(percentage)
+
+    @QtCore.pyqtSlot(str, str, str, str, str, list, str, int, int, str, list, list, str, object)
     def make_bootable_iso(self, device, filename, filesystem, partition_table, target, bootloader, label, clustersize,
-                          badblocks_passes, badblocks_file, syslinux, syslinux_modules, grldr):
+                          badblocks_passes, badblocks_file, syslinux, syslinux_modules, grldr, manifest):
         # Requires: parted, mkfs.*, bootloader(grub2, syslinux, grub4dos, systemd-boot)
         self.signal_set_enabled.emit(False)
         self.signal_set_progress.emit(0)
@@ -1035,17 +1265,31 @@ class WorkerObject(QtCore.QObject):
         self.signal_set_status.emit('Copying files...')
         self.signal_set_progress.emit(25)
 
-        # Mount the usb and the iso file.
+        # Mount the usb.
         usb_mountpoint = '/tmp/usbmaker' + str(os.getpid()) + '-usb'
-        iso_mountpoint = '/tmp/usbmaker' + str(os.getpid()) + '-iso'
         mount.mount(device + '1', usb_mountpoint)
-        mount.mount_iso(filename, iso_mountpoint)
-
-        # Copy the iso contents to the usb drive.
-        iso.copy_iso_contents(iso_mountpoint, usb_mountpoint)
 
-        # Unmount the iso file.
-        mount.unmount(iso_mountpoint)
+        # Copy the iso contents to the usb drive, using the manifest from
+        # start_iso(). The iso file is read directly, without mounting it,
+        # unless it's a UDF image, whose manifest was made from the mount
+        # point it's mounted on again. Either way, it's read from memory if
+        # it's staged.
+        iso_mountpoint = None
+        try:
+            iso_source = dd.get_staged_path(filename) or filename
+            if manifest.source != filename:
+                iso_mountpoint = manifest.source
+                mount.mount_iso(iso_source, iso_mountpoint)
+                iso_source = iso_mountpoint
+            iso.copy_iso_contents(iso_source, usb_mountpoint, progress=self.copy_progress, manifest=manifest)
+        except (iso.CopyError, iso.IsoError, OSError) as error:
+            mount.unmount(usb_mountpoint)
+            self.signal_set_status.emit('Error: ' + str(error))
+            self.signal_set_enabled.emit(True)
+            return
+        finally:
+            if iso_mountpoint is not None:
+                mount.unmount(iso_mountpoint)
 
         self.signal_set_status.emit('Installing the bootloader...')
         self.signal_set_progress.emit(80)
@@ -44,3 +44,22 @@ def unmount_all_partitions(device):
     partitions = usb_info.get_partitions(device)
     for partition in partitions:
         unmount_partition(partition)
+
+
+def get_filesystem_type(mountpoint):
+    # Returns the type (as in /proc/mounts, for example vfat) of the
+    # filesystem mounted on mountpoint, or None if nothing is mounted there.
+    mountpoint = os.path.realpath(mountpoint)
+    filesystem_type = None
+    with open('/proc/mounts', mode='r') as mounts_file:
+        for line in mounts_file:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            # Spaces, tabs, newlines and backslashes in mount points are
+            # escaped.
+            path = fields[1].replace('\\040', ' ').replace('\\011', '\t').replace('\\012', '\n')
+            if path.replace('\\134', '\\') == mountpoint:
+                # The last mount on the mount point hides the others.
+                filesystem_type = fields[2]
+    return filesystem_type
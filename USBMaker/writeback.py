@@ -0,0 +1,123 @@
+#   Copyright © 2017 Joaquim Monteiro
+#
+#   This file is part of USBMaker.
+#
+#   USBMaker is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   USBMaker is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with USBMaker.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import ctypes
+import ctypes.util
+
+# Default number of bytes a file can have dirty in the page cache before its
+# writeback is started.
+SYNC_INTERVAL = 32 * 1024 * 1024
+
+# Flags of sync_file_range(2).
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# sync_file_range() and syncfs() aren't in the os module, so they're called
+# from libc directly. If they aren't available, fdatasync() and sync() are
+# used instead.
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sync_file_range = _libc.sync_file_range
+    _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_uint]
+    _syncfs = _libc.syncfs
+    _syncfs.argtypes = [ctypes.c_int]
+except (OSError, AttributeError):
+    _sync_file_range = None
+    _syncfs = None
+
+
+def _check(result):
+    if result != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def start_writeback(fd, offset, length):
+    # Starts writing the range to the device, without waiting for it. A
+    # length of 0 means until the end of the file.
+    if _sync_file_range is not None:
+        _check(_sync_file_range(fd, offset, length, SYNC_FILE_RANGE_WRITE))
+
+
+def wait_writeback(fd, offset, length):
+    # Returns once the range is on the device.
+    if _sync_file_range is not None:
+        _check(_sync_file_range(fd, offset, length, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE |
+                                SYNC_FILE_RANGE_WAIT_AFTER))
+    else:
+        os.fdatasync(fd)
+
+
+def drop_cache(fd, offset, length):
+    # Removes the range from the page cache. Only clean pages are removed, so
+    # written data has to reach the device first.
+    os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def syncfs(path):
+    # Writes the dirty data of the filesystem mounted on path only, instead of
+    # every filesystem like os.sync().
+    if _syncfs is None:
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        _check(_syncfs(fd))
+    finally:
+        os.close(fd)
+
+
+class Writeback:
+    # Bounds the dirty data of a file that is written from start to end.
+    # After every interval bytes, the writeback of the new data is started
+    # and the data before it is waited for and removed from the page cache,
+    # so at most about two intervals are in memory at once.
+    def __init__(self, fd, interval=SYNC_INTERVAL):
+        self.fd = fd
+        self.interval = interval
+        # Offset up to which the data is on the device.
+        self.synced = 0
+        # Offset up to which the writeback was started.
+        self.started = 0
+
+    def written(self, end):
+        # Called with the offset up to which the file was written. Returns
+        # True if self.synced moved forward.
+        if end - self.started < self.interval:
+            return False
+        if _sync_file_range is None:
+            os.fdatasync(self.fd)
+            drop_cache(self.fd, self.synced, end - self.synced)
+            self.synced = self.started = end
+            return True
+
+        start_writeback(self.fd, self.started, end - self.started)
+        if self.started > self.synced:
+            wait_writeback(self.fd, self.synced, self.started - self.synced)
+            drop_cache(self.fd, self.synced, self.started - self.synced)
+        moved = self.started > self.synced
+        self.synced = self.started
+        self.started = end
+        return moved
+
+    def finish(self):
+        # Waits until everything is on the device and removes it from the
+        # page cache.
+        os.fdatasync(self.fd)
+        drop_cache(self.fd, self.synced, 0)
@@ -0,0 +1,284 @@
+#   Copyright © 2017 Joaquim Monteiro
+#
+#   This file is part of USBMaker.
+#
+#   USBMaker is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   USBMaker is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with USBMaker.  If not, see <https://www.gnu.org/licenses/>.
+
+# The "devices" are regular files: dd opens '/dev/' + device, so they're
+# given as paths relative to /dev.
+
+import sys
+import os
+import bz2
+import gzip
+import hashlib
+import lzma
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+# The modules of USBMaker import each other by name, like in __init__.py.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'USBMaker'))
+import dd  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class DdTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # The journals, tuning and digest cache are kept out of /var/tmp.
+        patches = {'JOURNAL_DIR': self.directory,
+                   'DIGEST_CACHE_PATH': os.path.join(self.directory, 'digests.json'),
+                   'TUNING_PATH': os.path.join(self.directory, 'tuning.json')}
+        for name, value in patches.items():
+            patcher = unittest.mock.patch.object(dd, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_file(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def make_device(self, name, size, fill=b'\xff'):
+        # Returns the device name of a file filled with fill.
+        path = self.make_file(name, fill * size)
+        return os.path.relpath(path, '/dev')
+
+    def read_device(self, device):
+        with open('/dev/' + device, 'rb') as device_file:
+            return device_file.read()
+
+
+class JournalTest(DdTestCase):
+    def test_interrupted_write_is_resumed(self):
+        data = os.urandom(12 * MIB + 123)
+        image = self.make_file('image.img', data)
+        device = self.make_device('device', len(data))
+
+        def interrupt(written, total):
+            if written >= 7 * MIB:
+                raise _Interrupted()
+
+        with unittest.mock.patch.object(dd, 'JOURNAL_INTERVAL', 2 * MIB), \
+                unittest.mock.patch.object(dd, 'JOURNAL_TAIL', MIB), \
+                unittest.mock.patch.object(dd, 'BLOCK_SIZE', MIB):
+            with self.assertRaises(_Interrupted):
+                dd.dd(image, device, block_size=MIB, progress=interrupt, journal_id='stick',
+                      sync_interval=MIB)
+            committed = dd._read_journal('stick', dd._get_source_identity(image, None))
+            self.assertGreater(committed, MIB)
+
+            # The start of the device isn't written again, and the journal's
+            # tail is still there, so the write is resumed.
+            with open('/dev/' + device, 'r+b') as device_file:
+                device_file.write(bytes(MIB))
+            hash_object = dd.new_hash('sha256')
+            written = dd.dd(image, device, block_size=MIB, journal_id='stick', hash_object=hash_object)
+
+        self.assertEqual(written, len(data))
+        contents = self.read_device(device)
+        self.assertEqual(contents[:MIB], bytes(MIB))
+        self.assertEqual(contents[MIB:], data[MIB:])
+        # The part that was skipped is still hashed.
+        self.assertEqual(hash_object.digest(), hashlib.sha256(data).digest())
+        self.assertFalse(os.path.exists(dd._get_journal_path('stick')))
+
+    def test_changed_tail_restarts_the_write(self):
+        data = os.urandom(6 * MIB)
+        image = self.make_file('image.img', data)
+        device = self.make_device('device', len(data))
+        committed = 4 * MIB
+        dd._write_journal('stick', dd._get_source_identity(image, None), committed)
+
+        # The device doesn't have the journal's tail, so it's written from
+        # the start.
+        with unittest.mock.patch.object(dd, 'JOURNAL_TAIL', MIB):
+            dd.dd(image, device, block_size=MIB, journal_id='stick')
+        self.assertEqual(self.read_device(device), data)
+
+
+class BmapTest(DdTestCase):
+    def make_sparse_image(self):
+        # Data at 0, 1 MiB and the last block, and zeros in between.
+        size = 4 * MIB + 1000
+        data = bytearray(size)
+        data[:5000] = os.urandom(5000)
+        data[MIB:MIB + 8192] = os.urandom(8192)
+        data[-1000:] = os.urandom(1000)
+        return self.make_file('image.img', bytes(data)), bytes(data)
+
+    def test_round_trip(self):
+        image, data = self.make_sparse_image()
+        bmap = dd.generate_bmap(image, scan_zeros=True)
+        path = image + '.bmap'
+        bmap.write(path)
+        self.assertEqual(dd.find_bmap(image), path)
+
+        read = dd.read_bmap(path)
+        self.assertEqual(read.ranges, bmap.ranges)
+        self.assertEqual(read.image_size, len(data))
+        self.assertEqual(read.get_extents(), [(0, 8192), (MIB, MIB + 8192), (4 * MIB, 4 * MIB + 1000)])
+
+    def test_only_mapped_ranges_are_written(self):
+        image, data = self.make_sparse_image()
+        path = image + '.bmap'
+        dd.generate_bmap(image, scan_zeros=True).write(path)
+        device = self.make_device('device', len(data))
+
+        written = dd.dd(image, device, block_size=MIB, bmap=path)
+        self.assertEqual(written, 8192 + 8192 + 1000)
+        contents = self.read_device(device)
+        for start, end in dd.read_bmap(path).get_extents():
+            self.assertEqual(contents[start:end], data[start:end])
+        self.assertEqual(contents[2 * MIB:3 * MIB], b'\xff' * MIB)
+
+        self.assertTrue(dd.dd_check(image, device, block_size=MIB, bmap=path))
+        with open('/dev/' + device, 'r+b') as device_file:
+            device_file.seek(MIB + 100)
+            device_file.write(b'x')
+        self.assertFalse(dd.dd_check(image, device, block_size=MIB, bmap=path))
+
+    def test_wrong_checksum(self):
+        image, data = self.make_sparse_image()
+        bmap = dd.generate_bmap(image, scan_zeros=True)
+        first, last, checksum = bmap.ranges[1]
+        bmap.ranges[1] = (first, last, '0' * len(checksum))
+        device = self.make_device('device', len(data))
+        with self.assertRaises(dd.ChecksumError):
+            dd.dd(image, device, block_size=MIB, bmap=bmap)
+
+    def test_corrupt_bmap_file(self):
+        path = self.make_file('image.img.bmap', b'<bmap><ImageSize>12')
+        with self.assertRaises(dd.ChecksumError):
+            dd.read_bmap(path)
+
+
+class ZeroPolicyTest(DdTestCase):
+    def test_zero_blocks_are_written(self):
+        # Regular files can't be zeroed with BLKZEROOUT, so the zero blocks
+        # have to be written anyway.
+        data = os.urandom(MIB) + bytes(2 * MIB) + os.urandom(MIB)
+        image = self.make_file('image.img', data)
+        for zero_policy in ('write', 'zeroout', 'skip'):
+            device = self.make_device('device-' + zero_policy, len(data))
+            dd.dd(image, device, block_size=MIB, zero_policy=zero_policy)
+            self.assertEqual(self.read_device(device), data, zero_policy)
+
+
+class CompressedTest(DdTestCase):
+    compressors = {'.xz': lzma.compress, '.gz': gzip.compress, '.bz2': bz2.compress}
+
+    def check_round_trip(self):
+        data = os.urandom(3 * MIB) + bytes(MIB) + b'end'
+        for extension, compress in self.compressors.items():
+            image = self.make_file('image.img' + extension, compress(data))
+            device = self.make_device('device' + extension, len(data) + MIB)
+            hash_object = dd.new_hash('sha256')
+            written = dd.dd(image, device, block_size=MIB, hash_object=hash_object)
+            self.assertEqual(written, len(data), extension)
+            self.assertEqual(self.read_device(device)[:len(data)], data, extension)
+            self.assertTrue(dd.dd_check(image, device, block_size=MIB, iso_digest=hash_object.digest(),
+                                        size=written, algorithm='sha256'), extension)
+            # The digest was cached, once the device matched it.
+            self.assertEqual(dd.get_cached_digest(image, 'sha256'), hash_object.digest())
+
+    def test_round_trip(self):
+        self.check_round_trip()
+
+    def test_round_trip_without_tools(self):
+        # Python's decompressors are used instead of the command line tools.
+        with unittest.mock.patch('shutil.which', return_value=None):
+            self.check_round_trip()
+
+    def test_corrupt_image(self):
+        data = os.urandom(2 * MIB)
+        for extension, compress in self.compressors.items():
+            compressed = compress(data)
+            image = self.make_file('image.img' + extension, compressed[:len(compressed) // 2])
+            device = self.make_device('device' + extension, len(data))
+            with unittest.mock.patch('shutil.which', return_value=None):
+                with self.assertRaises(OSError):
+                    dd.dd(image, device, block_size=MIB)
+
+
+class DigestCacheTest(DdTestCase):
+    def test_wrong_digest_is_not_cached(self):
+        data = os.urandom(MIB)
+        image = self.make_file('image.img', data)
+        device = self.make_device('device', len(data))
+        dd.dd(image, device)
+
+        self.assertFalse(dd.dd_check(image, device, iso_digest=bytes(32), algorithm='sha256'))
+        self.assertIsNone(dd.get_cached_digest(image, 'sha256'))
+        self.assertTrue(dd.dd_check(image, device, algorithm='sha256'))
+        self.assertEqual(dd.get_cached_digest(image, 'sha256'), hashlib.sha256(data).digest())
+
+
+class DdMultiTest(DdTestCase):
+    @unittest.skipUnless(os.path.exists('/dev/full'), 'needs /dev/full')
+    def test_failing_device_is_dropped(self):
+        # Writes to /dev/full fail with ENOSPC.
+        data = os.urandom(5 * MIB + 17)
+        image = self.make_file('image.img', data)
+        devices = [self.make_device('device-1', len(data)), 'full', self.make_device('device-2', len(data))]
+
+        results = dd.dd_multi(image, devices, block_size=MIB, ring_size=4, stall_timeout=10)
+        self.assertFalse(results['full'].is_ok())
+        self.assertIsInstance(results['full'].error, dd.WriteError)
+        for device in (devices[0], devices[2]):
+            self.assertTrue(results[device].is_ok(), str(results[device]))
+            self.assertEqual(results[device].written, len(data))
+            self.assertEqual(self.read_device(device), data)
+
+    def test_missing_device(self):
+        data = os.urandom(MIB)
+        image = self.make_file('image.img', data)
+        device = self.make_device('device', len(data))
+        missing = os.path.relpath(os.path.join(self.directory, 'missing', 'device'), '/dev')
+
+        results = dd.dd_multi(image, [device, missing], block_size=MIB)
+        self.assertTrue(results[device].is_ok())
+        self.assertFalse(results[missing].is_ok())
+
+
+class IndexTest(DdTestCase):
+    def test_damaged_chunks_are_found(self):
+        data = os.urandom(10 * MIB)
+        image = self.make_file('image.img', data)
+        device = self.make_device('device', len(data))
+        dd.dd(image, device)
+
+        index = dd.generate_index(image, chunk_size=MIB)
+        self.assertTrue(dd.dd_check_index(index, device).is_ok())
+
+        with open('/dev/' + device, 'r+b') as device_file:
+            device_file.seek(3 * MIB + 10)
+            device_file.write(b'x')
+        result = dd.dd_check_index(index, device)
+        self.assertEqual(result.mismatches, [(3 * MIB, 4 * MIB)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+#   Copyright © 2017 Joaquim Monteiro
+#
+#   This file is part of USBMaker.
+#
+#   USBMaker is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   USBMaker is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with USBMaker.  If not, see <https://www.gnu.org/licenses/>.
+
+# The fixture images in data/ were made with bsdtar (libarchive 3.7):
+# - rockridge.iso: bsdtar -c -f rockridge.iso --format iso9660 -C rr .
+#   rr has a/b/c/d/e/f/g/h/i/file.txt (deeper than ISO 9660 allows, so
+#   a/b/c/d/e/f/g is relocated to rr_moved), boot/grub/grub.cfg,
+#   "A long file name with spaces.txt", a symlink "link" to
+#   boot/grub/grub.cfg, an empty empty.txt and data.bin (5000 x's).
+# - joliet.iso: bsdtar -c -f joliet.iso --format iso9660 --options '!rockridge' -C joliet .
+#   joliet has boot/grub/grub.cfg, "A long file name with spaces.txt" and
+#   MixedCase.txt.
+# Images with multi-extent files and UDF images are built by the tests.
+
+import sys
+import os
+import lzma
+import shutil
+import struct
+import tempfile
+import unittest
+
+# The modules of USBMaker import each other by name, like in __init__.py.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'USBMaker'))
+import iso  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def _directory_record(name, extent, size, flags):
+    length = 33 + len(name) + (1 - len(name) % 2)
+    record = bytearray(length)
+    record[0] = length
+    struct.pack_into('<I', record, 2, extent)
+    struct.pack_into('>I', record, 6, extent)
+    struct.pack_into('<I', record, 10, size)
+    struct.pack_into('>I', record, 14, size)
+    record[25] = flags
+    struct.pack_into('<H', record, 28, 1)
+    struct.pack_into('>H', record, 30, 1)
+    record[32] = len(name)
+    record[33:33 + len(name)] = name
+    return bytes(record)
+
+
+def _build_image(path, records, data=b''):
+    # A plain ISO 9660 image whose root directory has the given records
+    # after "." and "..". The primary volume descriptor is in sector 16, the
+    # terminator in sector 17, the root directory in sector 18 and data
+    # starts at sector 19.
+    sector_size = iso.ISO_SECTOR_SIZE
+    root_record = _directory_record(b'\x00', 18, sector_size, iso.ISO_DIRECTORY_FLAG)
+    root = root_record + _directory_record(b'\x01', 18, sector_size, iso.ISO_DIRECTORY_FLAG) + b''.join(records)
+
+    primary = bytearray(sector_size)
+    primary[0:7] = b'\x01CD001\x01'
+    struct.pack_into('<H', primary, 128, sector_size)
+    primary[156:156 + len(root_record)] = root_record
+    terminator = bytearray(sector_size)
+    terminator[0:7] = b'\xffCD001\x01'
+
+    with open(path, 'wb') as image_file:
+        image_file.write(bytes(16 * sector_size) + primary + terminator + root + bytes(sector_size - len(root)) +
+                         data)
+
+
+def _build_multi_extent_image(path, parts):
+    # An image with a single file, BIG.BIN, stored in one extent per part.
+    sector_size = iso.ISO_SECTOR_SIZE
+    records = []
+    data = b''
+    extent = 19
+    for number, part in enumerate(parts):
+        flags = iso.ISO_MULTI_EXTENT_FLAG if number < len(parts) - 1 else 0
+        records.append(_directory_record(b'BIG.BIN;1', extent, len(part), flags))
+        padded = part + bytes(-len(part) % sector_size)
+        data += padded
+        extent += len(padded) // sector_size
+    _build_image(path, records, data)
+
+
+class IsoImageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # Extracted directories are read-only, like in the image.
+        for directory, directories, files in os.walk(self.directory):
+            os.chmod(directory, 0o755)
+        shutil.rmtree(self.directory)
+
+    def get_fixture(self, name):
+        # The fixtures are stored compressed.
+        path = os.path.join(self.directory, name)
+        with lzma.open(os.path.join(DATA_DIR, name + '.xz')) as compressed_file, open(path, 'wb') as image_file:
+            shutil.copyfileobj(compressed_file, image_file)
+        return path
+
+    def read_file(self, image, entry):
+        path = os.path.join(self.directory, 'extracted')
+        iso._extract_files(image, [(entry.path, entry, path)], iso.CopyResult(), None)
+        with open(path, 'rb') as extracted_file:
+            return extracted_file.read()
+
+
+class RockRidgeTest(IsoImageTestCase):
+    def test_names_and_types(self):
+        with iso.IsoImage(self.get_fixture('rockridge.iso')) as image:
+            self.assertTrue(image.rock_ridge)
+            entries = {entry.path: entry for entry in image.walk()}
+
+        self.assertEqual(entries['A long file name with spaces.txt'].kind, 'file')
+        self.assertEqual(entries['boot/grub'].kind, 'directory')
+        self.assertEqual(entries['boot/grub/grub.cfg'].size, 16)
+        self.assertEqual(entries['empty.txt'].size, 0)
+        self.assertEqual(entries['data.bin'].mode & 0o170000, 0o100000)
+
+    def test_symlink(self):
+        with iso.IsoImage(self.get_fixture('rockridge.iso')) as image:
+            link = image.get_entry('link')
+            self.assertEqual(link.kind, 'symlink')
+            self.assertEqual(link.target, 'boot/grub/grub.cfg')
+            self.assertEqual(image.resolve(link).path, 'boot/grub/grub.cfg')
+
+    def test_file_contents(self):
+        with iso.IsoImage(self.get_fixture('rockridge.iso')) as image:
+            self.assertEqual(self.read_file(image, image.get_entry('data.bin')), b'x' * 5000)
+            self.assertEqual(self.read_file(image, image.get_entry('boot/grub/grub.cfg')), b'menuentry linux\n')
+            self.assertEqual(self.read_file(image, image.get_entry('empty.txt')), b'')
+
+
+class RelocatedDirectoryTest(IsoImageTestCase):
+    def test_relocated_directory_is_shown_in_place(self):
+        with iso.IsoImage(self.get_fixture('rockridge.iso')) as image:
+            paths = [entry.path for entry in image.walk()]
+            deep_file = image.get_entry('a/b/c/d/e/f/g/h/i/file.txt')
+            self.assertEqual(self.read_file(image, deep_file), b'deep\n')
+
+        self.assertIn('a/b/c/d/e/f/g', paths)
+        # The relocated directory is only shown where it belongs, and
+        # rr_moved is left empty, like the kernel shows it.
+        self.assertEqual([path for path in paths if path.startswith('rr_moved/')], [])
+        self.assertLess(paths.index('a/b/c/d/e/f/g'), paths.index('a/b/c/d/e/f/g/h'))
+
+
+class JolietTest(IsoImageTestCase):
+    def test_names(self):
+        with iso.IsoImage(self.get_fixture('joliet.iso')) as image:
+            self.assertFalse(image.rock_ridge)
+            self.assertTrue(image.joliet)
+            paths = set(entry.path for entry in image.walk())
+            self.assertEqual(self.read_file(image, image.get_entry('MixedCase.txt')), b'case\n')
+
+        self.assertEqual(paths, {'A long file name with spaces.txt', 'MixedCase.txt', 'boot', 'boot/grub',
+                                 'boot/grub/grub.cfg'})
+
+
+class MultiExtentTest(IsoImageTestCase):
+    def test_extents_are_joined(self):
+        path = os.path.join(self.directory, 'multi.iso')
+        parts = [b'a' * iso.ISO_SECTOR_SIZE, b'b' * iso.ISO_SECTOR_SIZE, b'c' * 100]
+        _build_multi_extent_image(path, parts)
+
+        with iso.IsoImage(path) as image:
+            entries = list(image.walk())
+            self.assertEqual([entry.path for entry in entries], ['big.bin'])
+            self.assertEqual(entries[0].size, sum(len(part) for part in parts))
+            self.assertEqual(len(entries[0].extents), 3)
+            self.assertEqual(self.read_file(image, entries[0]), b''.join(parts))
+
+
+class ExtractTest(IsoImageTestCase):
+    def test_copy_iso_contents(self):
+        image = self.get_fixture('rockridge.iso')
+        destination = os.path.join(self.directory, 'usb')
+        os.mkdir(destination)
+        result = iso.copy_iso_contents(image, destination)
+
+        with open(os.path.join(destination, 'data.bin'), 'rb') as data_file:
+            self.assertEqual(data_file.read(), b'x' * 5000)
+        with open(os.path.join(destination, 'a/b/c/d/e/f/g/h/i/file.txt'), 'rb') as deep_file:
+            self.assertEqual(deep_file.read(), b'deep\n')
+        self.assertEqual(os.path.getsize(os.path.join(destination, 'empty.txt')), 0)
+        self.assertEqual(os.readlink(os.path.join(destination, 'link')), 'boot/grub/grub.cfg')
+        self.assertEqual(result.total, 5000 + 16 + 5 + 5)
+
+
+class CopyMethodsTest(IsoImageTestCase):
+    def test_methods_are_chosen_by_destination(self):
+        source = os.path.join(self.directory, 'source')
+        destination = os.path.join(self.directory, 'destination')
+        with open(source, 'wb'), open(destination, 'wb'):
+            pass
+        source_fd = os.open(source, os.O_RDONLY)
+        destination_fd = os.open(destination, os.O_WRONLY)
+        read_fd, write_fd = os.pipe()
+        try:
+            # Both files are on the same filesystem.
+            self.assertEqual(iso._get_copy_methods(source_fd, destination_fd)[0], 'copy_file_range')
+            self.assertEqual(iso._get_copy_methods(source_fd, write_fd)[0], 'splice')
+            self.assertEqual(iso._get_copy_methods(source_fd, write_fd)[-1], 'buffer')
+        finally:
+            for fd in (source_fd, destination_fd, read_fd, write_fd):
+                os.close(fd)
+
+
+class ManifestTest(IsoImageTestCase):
+    def test_image_is_walked_once(self):
+        with iso.IsoImage(self.get_fixture('rockridge.iso')) as image:
+            manifest = iso.get_manifest(image)
+            walk = image.walk
+            image.walk = None
+            self.assertEqual(manifest.get_total_size(), 5000 + 16 + 5 + 5)
+            self.assertFalse(iso.has_uefi_bootloader(image))
+            self.assertEqual(iso.get_uefi_bootloader_name(image), 'grub2')
+            self.assertEqual([entry.path for entry in manifest.entries], [entry.path for entry in walk()])
+
+
+class CorruptImageTest(IsoImageTestCase):
+    def test_directory_loop(self):
+        # A directory whose extent is the root directory's.
+        path = os.path.join(self.directory, 'loop.iso')
+        _build_image(path, [_directory_record(b'LOOP', 18, iso.ISO_SECTOR_SIZE, iso.ISO_DIRECTORY_FLAG)])
+        with iso.IsoImage(path) as image:
+            with self.assertRaises(iso.IsoError):
+                list(image.walk())
+
+    def test_record_length_past_sector(self):
+        # A name longer than the record.
+        path = os.path.join(self.directory, 'length.iso')
+        record = bytearray(_directory_record(b'FILE.TXT;1', 19, 0, 0))
+        record[32] = 200
+        _build_image(path, [bytes(record)])
+        with self.assertRaises(iso.IsoError):
+            with iso.IsoImage(path) as image:
+                list(image.walk())
+
+    def test_record_crosses_sector(self):
+        # A record that starts at the end of the root directory's sector and
+        # runs past it.
+        path = os.path.join(self.directory, 'cross.iso')
+        records = [_directory_record(b'FILE%04d.TXT;1' % number, 19, 0, 0) for number in range(40)]
+        _build_image(path, records)
+        with open(path, 'r+b') as image_file:
+            image_file.seek(18 * iso.ISO_SECTOR_SIZE + 68 + sum(len(record) for record in records))
+            image_file.write(bytes([120]))
+        with self.assertRaises(iso.IsoError):
+            with iso.IsoImage(path) as image:
+                list(image.walk())
+
+
+class SeekDistanceTest(unittest.TestCase):
+    def test_empty_files_are_skipped(self):
+        files = [iso.IsoEntry('a', 'file', 100, [(4096, 100)]),
+                 iso.IsoEntry('empty', 'file', 0, [(0, 0)]),
+                 iso.IsoEntry('b', 'file', 100, [(6144, 100)])]
+        self.assertEqual(iso._get_seek_distance(files), 6144 - 4196)
+
+
+class UdfTest(IsoImageTestCase):
+    def write_descriptors(self, path, sector, identifiers):
+        with open(path, 'r+b') as image_file:
+            for identifier in identifiers:
+                image_file.seek(sector * iso.ISO_SECTOR_SIZE)
+                image_file.write(b'\x00' + identifier + b'\x01')
+                sector += 1
+
+    def test_iso_9660_images(self):
+        self.assertFalse(iso.is_udf(self.get_fixture('rockridge.iso')))
+        self.assertFalse(iso.is_udf(self.get_fixture('joliet.iso')))
+
+    def test_udf_bridge_image(self):
+        # The volume recognition sequence follows the ISO 9660 terminator.
+        path = self.get_fixture('joliet.iso')
+        with open(path, 'rb') as image_file:
+            sector = iso.ISO_FIRST_DESCRIPTOR
+            image_file.seek(sector * iso.ISO_SECTOR_SIZE)
+            while image_file.read(iso.ISO_SECTOR_SIZE)[0] != 255:
+                sector += 1
+        self.write_descriptors(path, sector + 1, [b'BEA01', b'NSR02', b'TEA01'])
+        self.assertTrue(iso.is_udf(path))
+
+    def test_udf_only_image(self):
+        path = os.path.join(self.directory, 'udf.iso')
+        with open(path, 'wb') as image_file:
+            image_file.write(bytes(20 * iso.ISO_SECTOR_SIZE))
+        self.write_descriptors(path, iso.ISO_FIRST_DESCRIPTOR, [b'BEA01', b'NSR03', b'TEA01'])
+        self.assertTrue(iso.is_udf(path))
+
+
+if __name__ == '__main__':
+    unittest.main()